@@ -1,36 +1,153 @@
 #!/usr/bin/env python3
+import functools
+import json
+
 from aws_cdk import core as cdk
 
-from sm_domain.sm_domain_stack import SMSDomainStack
-from sm_domain.vpc_construct import VpcStack
-from sm_user.service_catalog_construct import ServiceCatalogStudioUserStack
+app = cdk.App()
 
-# To use the default VPC, it is necessary to define the environment.
-# from dotenv import find_dotenv, load_dotenv
-# load_dotenv(find_dotenv())
-#
-# env = cdk.Environment(
-#     region=os.getenv("CDK_DEPLOY_REGION"), account=os.getenv("CDK_DEPLOY_ACCOUNT")
-# )
+# To use the default VPC, it is necessary to define the environment:
+# cdk synth -c account=123456789012 -c region=eu-west-1
+env = None
+if app.node.try_get_context("account") or app.node.try_get_context("region"):
+    env = cdk.Environment(
+        account=app.node.try_get_context("account"),
+        region=app.node.try_get_context("region"),
+    )
+
+# Several domains in the same account and region need their own stack names
+# and exports: cdk synth -c namespace=research-dev, see fleet.py
+namespace = app.node.try_get_context("namespace")
+prefix = f"{namespace}-" if namespace else ""
+
+# How the stacks read the domain id, the provider token... published by the
+# others: from CloudFormation exports, or from SSM parameters, which lets the
+# stacks update and deploy independently: cdk deploy -c lookup=ssm
+lookup = app.node.try_get_context("lookup") or "exports"
+
+# S3 prefixes cached on the Studio EFS, by name:
+# cdk deploy -c datasets='{"course": "s3://bucket/course-data/"}'
+datasets = app.node.try_get_context("datasets")
+if isinstance(datasets, str):
+    datasets = json.loads(datasets)
+
+# Execution roles of the teams, besides the default one, allowed to use
+# SageMaker Projects: cdk deploy -c project_roles='["arn:aws:iam::...:role/team-a"]'
+project_roles = app.node.try_get_context("project_roles")
+if isinstance(project_roles, str):
+    project_roles = json.loads(project_roles)
+
+# VPC endpoints, all the defaults or by name, and the NAT gateways, none once
+# the functions reach everything through the endpoints:
+# cdk deploy -c vpc_endpoints=all -c nat_gateways=0
+# cdk deploy -c vpc_endpoints=s3,sagemaker_api,logs
+vpc_endpoints = app.node.try_get_context("vpc_endpoints") or []
+if vpc_endpoints in (True, "true"):
+    vpc_endpoints = ["all"]
+elif isinstance(vpc_endpoints, str) and vpc_endpoints.startswith("["):
+    vpc_endpoints = json.loads(vpc_endpoints)
+elif isinstance(vpc_endpoints, str):
+    vpc_endpoints = [k.strip() for k in vpc_endpoints.split(",") if k.strip()]
+nat_gateways = app.node.try_get_context("nat_gateways")
+
+
+@functools.lru_cache(maxsize=None)
+def vpc_stack():
+    from sm_domain.vpc_construct import DEFAULT_ENDPOINTS, VpcStack
+
+    return VpcStack(
+        app,
+        f"{prefix}SageMakerStudioVpc",
+        endpoints=[
+            name
+            for k in vpc_endpoints
+            for name in (DEFAULT_ENDPOINTS if k == "all" else [k])
+        ],
+        nat_gateways=1 if nat_gateways is None else int(nat_gateways),
+        env=env,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def domain_stack():
+    from sm_domain.sm_domain_stack import SMSDomainStack
+
+    return SMSDomainStack(
+        app,
+        f"{prefix}SageMakerStudioDomain",
+        vpc=vpc_stack().vpc,
+        project_role_arns=project_roles,
+        export_prefix=prefix,
+        lookup=lookup,
+        # The SageMaker Projects roles are named, only one domain per account
+        # creates them: cdk deploy -c service_catalog_roles=false
+        service_catalog_roles=app.node.try_get_context("service_catalog_roles")
+        not in (False, "false"),
+        env=env,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def service_catalog_stack():
+    from sm_user.service_catalog_construct import ServiceCatalogStudioUserStack
+
+    return ServiceCatalogStudioUserStack(
+        app,
+        f"{prefix}ServiceCatalogStudioUserStack",
+        domain=domain_stack(),
+        # Optional folder packaged as the default S3 seed archive: cdk synth -c seed_source=<path>
+        seed_source=app.node.try_get_context("seed_source"),
+        # Optional folder applied to every user home: cdk synth -c home_template=<path>
+        home_template=app.node.try_get_context("home_template"),
+        datasets=datasets,
+        # Clone to the Lambda local storage of that size, then copy to EFS in parallel:
+        # cdk deploy -c staging_storage_mb=4096
+        staging_storage_mb=int(app.node.try_get_context("staging_storage_mb") or 0),
+        # Scan the EFS usage of every user hourly: cdk deploy -c usage_report=true
+        usage_report=app.node.try_get_context("usage_report") in (True, "true"),
+        # Populate the home folders beyond the 15 minutes Lambda limit: cdk deploy -c async_mode=true
+        async_mode=app.node.try_get_context("async_mode") in (True, "true"),
+        export_prefix=prefix,
+        lookup=lookup,
+        env=env,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def user_profiles_stack():
+    from sm_roster.reconciler import load_roster
+    from sm_user.studio_users_stack import StudioUsersStack
+
+    user_shards = app.node.try_get_context("user_shards")
+    stack = StudioUsersStack(
+        app,
+        f"{prefix}StudioUsers",
+        roster=load_roster(app.node.try_get_context("user_profiles")),
+        # Required, and fixed once deployed: the users of each shard depend on it
+        shards=int(user_shards) if user_shards else None,
+        export_prefix=prefix,
+        lookup=lookup,
+        env=env,
+    )
+    # Reads the exports of both
+    stack.add_dependency(domain_stack())
+    stack.add_dependency(service_catalog_stack())
+    return stack
 
-app = cdk.App()
 
-vpc = VpcStack(
-    app,
-    "SageMakerStudioVpc",
-    # env=env
-)
-studio_domain = SMSDomainStack(
-    app,
-    "SageMakerStudioDomain",
-    vpc=vpc.vpc,
-    # env=env
-)
-studio_user_sc = ServiceCatalogStudioUserStack(
-    app,
-    "ServiceCatalogStudioUserStack",
-    domain=studio_domain,
-    # env=env
-)
+STACKS = {
+    "SageMakerStudioVpc": vpc_stack,
+    "SageMakerStudioDomain": domain_stack,
+    "ServiceCatalogStudioUserStack": service_catalog_stack,
+}
+# Users declared in the roster file, without Service Catalog:
+# cdk deploy -c user_profiles=roster.yaml -c user_shards=10
+if app.node.try_get_context("user_profiles"):
+    STACKS["StudioUsers"] = user_profiles_stack
+# The modules of each stack are only imported when the stack is built, and
+# with -c stacks=<name>,... only the named stacks and the ones they depend on are
+selected = app.node.try_get_context("stacks")
+for name in selected.split(",") if selected else STACKS:
+    STACKS[name.strip()]()
 
 app.synth()
@@ -0,0 +1,121 @@
+"""boto3 clients shared by the custom resource handlers.
+
+Shipped as a Lambda layer, so every handler gets the same behaviour under burst
+load: clients are created on first use and reused across invocations, keep
+their connections alive, retry throttled calls with the adaptive mode and
+pace each API call through a client-side token bucket.
+
+    from aws_clients import client
+
+    client("sagemaker").describe_user_profile(...)
+
+The emf module next to this one writes metrics in CloudWatch embedded metric
+format.
+"""
+
+import json
+import os
+import threading
+import time
+
+# Calls per second and burst size allowed for each API, by default and per
+# "service.Operation". Overridden with the AWS_CLIENT_RATE_LIMITS environment
+# variable, e.g. {"sagemaker.DescribeUserProfile": [5, 10]}
+DEFAULT_RATE_LIMIT = (20, 20)
+RATE_LIMITS = {
+    "sagemaker.DescribeUserProfile": (10, 10),
+    "servicecatalog.AssociatePrincipalWithPortfolio": (5, 5),
+    "servicecatalog.DisassociatePrincipalFromPortfolio": (5, 5),
+}
+RATE_LIMITS.update(
+    {
+        k: tuple(v)
+        for k, v in json.loads(os.environ.get("AWS_CLIENT_RATE_LIMITS", "{}")).items()
+    }
+)
+
+CONFIG_OPTIONS = dict(
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    max_pool_connections=50,
+    connect_timeout=5,
+    read_timeout=60,
+)
+
+
+def _config():
+    from botocore.config import Config
+
+    try:
+        return Config(tcp_keepalive=True, **CONFIG_OPTIONS)
+    except TypeError:
+        # botocore older than 1.27
+        return Config(**CONFIG_OPTIONS)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_lock = threading.Lock()
+_clients = {}
+_buckets = {}
+_calls = threading.local()
+
+
+def _bucket(api):
+    with _lock:
+        if api not in _buckets:
+            _buckets[api] = TokenBucket(*RATE_LIMITS.get(api, DEFAULT_RATE_LIMIT))
+        return _buckets[api]
+
+
+def _throttle(model, **kwargs):
+    _bucket(f"{model.service_model.service_name}.{model.name}").acquire()
+
+
+def _count_retries(parsed, **kwargs):
+    attempts = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    _calls.retries = retries() + attempts
+
+
+def retries():
+    """Number of retried AWS calls made by the current thread so far."""
+    return getattr(_calls, "retries", 0)
+
+
+def client(service_name, **kwargs):
+    """Return the shared client for service_name, creating it on first use.
+
+    boto3 itself is only imported then, so handlers that make no AWS call in an
+    invocation don't pay for it at cold start.
+    """
+    key = (service_name, tuple(sorted(kwargs.items())))
+    if key not in _clients:
+        with _lock:
+            if key not in _clients:
+                import boto3
+
+                new_client = boto3.client(service_name, config=_config(), **kwargs)
+                new_client.meta.events.register("before-call.*.*", _throttle)
+                new_client.meta.events.register("after-call.*.*", _count_retries)
+                _clients[key] = new_client
+    return _clients[key]
@@ -0,0 +1,94 @@
+"""Metrics written to the function log in CloudWatch embedded metric format.
+
+Each flush() prints one JSON line that CloudWatch Logs turns into metrics, with
+no API call and no agent:
+
+    metrics = MetricsLogger(Domain="d-123", Repository="https://...")
+    with metrics.timer("Clone"):
+        ...
+    metrics.put("FilesChowned", 1234)
+    metrics.flush()
+
+Every line also carries the ColdStart property, true for the first invocation
+of the execution environment, so it can be filtered out of the percentiles.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "SageMakerStudio/UserSetup")
+
+# Lets the handlers measure the time spent importing their own modules
+IMPORTED_AT = time.monotonic()
+
+_lock = threading.Lock()
+_invocations = 0
+
+
+def new_invocation():
+    """Mark the start of an invocation, to be called first by the handler."""
+    global _invocations
+    with _lock:
+        _invocations += 1
+
+
+def cold_start():
+    return _invocations <= 1
+
+
+class MetricsLogger:
+    def __init__(self, namespace=NAMESPACE, **dimensions):
+        self.namespace = namespace
+        self.dimensions = {k: str(v) for k, v in dimensions.items()}
+        self.values = {}
+        self.units = {}
+
+    def put(self, name, value, unit="Count"):
+        self.values[name] = value
+        self.units[name] = unit
+
+    def add(self, name, value, unit="Count"):
+        self.put(name, self.values.get(name, 0) + value, unit)
+
+    @contextmanager
+    def timer(self, phase):
+        """Record the time spent in the block as the <phase>Duration metric."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(
+                f"{phase}Duration",
+                round((time.monotonic() - start) * 1000, 1),
+                "Milliseconds",
+            )
+
+    def flush(self):
+        if not self.values:
+            return
+        # One roll-up per dimension, then by dimension set (e.g. Domain, then
+        # Domain and Repository)
+        names = list(self.dimensions)
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [names[: i + 1] for i in range(len(names))],
+                        "Metrics": [
+                            {"Name": k, "Unit": self.units[k]} for k in self.values
+                        ],
+                    }
+                ],
+            },
+            "ColdStart": cold_start(),
+        }
+        record.update(self.dimensions)
+        record.update(self.values)
+        print(json.dumps(record))
+        self.values = {}
+        self.units = {}
@@ -0,0 +1,223 @@
+"""Benchmark the home folder setup of populate_from_git without AWS.
+
+    python -m benchmarks.populate [--users 4] [--files 2000] [--latency-ms 1]
+        [--baseline benchmarks/baseline.json] [--save-baseline]
+
+Synthetic bare repositories are cloned into a temporary folder standing in for
+the EFS volume, with a stubbed SageMaker client returning the home folder UID.
+Every user is then set up a second time, which moves the first clones to the
+trash, and the trash is purged. The throughput of the clone, chown and delete
+phases, read from the metrics logged by the handler, is compared with the
+baseline: the run fails when any of them drops by more than the tolerance.
+
+--latency-ms adds a delay to every metadata operation made by the handler
+itself (chown, lstat, scandir, unlink, rmdir, mkdir, rename) to mimic NFS.
+The writes of the git processes are not delayed.
+
+Needs git and the packages of populate_git_fn/requirements.txt. Run as root to
+measure real ownership changes: otherwise the files are given to the current
+user, which they already belong to, and the chown phase only checks them.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.repos import make_repo
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+# Functions delayed by --latency-ms, as looked up by the handler modules
+SLOW_OPERATIONS = ["chown", "lstat", "scandir", "unlink", "rmdir", "mkdir", "rename"]
+
+
+def add_latency(seconds):
+    """Make the metadata operations of the os module take at least seconds."""
+
+    def slow(fn):
+        def wrapper(*args, **kwargs):
+            time.sleep(seconds)
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    for name in SLOW_OPERATIONS:
+        setattr(os, name, slow(getattr(os, name)))
+
+
+class StubSageMaker:
+    def __init__(self, uids):
+        self.uids = uids
+
+    def describe_user_profile(self, DomainId, UserProfileName):
+        return {"HomeEfsFileSystemUid": str(self.uids[UserProfileName])}
+
+
+def emf_records(output):
+    return [json.loads(k) for k in output.splitlines() if k.startswith('{"_aws"')]
+
+
+def total(records, name):
+    return sum(k.get(name, 0) for k in records)
+
+
+def run_once(efs_root, repos, args, uids):
+    """Set up every user twice, purge the trash and return the throughputs."""
+    import populate_from_git
+    from ownership import iter_tree
+    from trash import purge
+
+    records = []
+    start = time.monotonic()
+    for _ in range(2):
+        for user in uids:
+            event = {
+                "RequestType": "Create",
+                "ResourceProperties": {
+                    "StudioUserName": user,
+                    "DomainID": "d-benchmark",
+                    "GitRepository": "",
+                    "GitRepositories": json.dumps([k.as_uri() for k in repos]),
+                    "GitCache": args.cache,
+                },
+            }
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                response = populate_from_git.on_event(event, None)
+            if response["Data"]["Failed"]:
+                sys.stderr.write(output.getvalue())
+                raise RuntimeError(f"Setup of {user} failed")
+            records += emf_records(output.getvalue())
+    setup_seconds = time.monotonic() - start
+
+    trash_root = efs_root / ".trash"
+    entries = sum(1 for _ in iter_tree(trash_root))
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = purge(trash_root, deadline=time.monotonic() + 3600)
+    delete_seconds = time.monotonic() - start
+    if stats["remaining"]:
+        raise RuntimeError("Trash not purged")
+
+    steps = [k for k in records if "Repository" in k]
+    chowned = total(steps, "FilesChowned") or total(steps, "FilesWritten")
+    if args.staging:
+        # Ownership is set by the copy as it writes
+        return {
+            "clone_mb_per_s": total(steps, "BytesReceived")
+            / 2**20
+            / (total(steps, "CloneDuration") / 1000),
+            "copy_files_per_s": total(steps, "FilesWritten")
+            / (total(steps, "CopyDuration") / 1000),
+            "delete_files_per_s": entries / delete_seconds,
+            "users_per_min": 2 * len(uids) / setup_seconds * 60,
+        }
+    return {
+        "clone_files_per_s": total(steps, "FilesWritten")
+        / (total(steps, "CloneDuration") / 1000),
+        "clone_mb_per_s": total(steps, "BytesReceived")
+        / 2**20
+        / (total(steps, "CloneDuration") / 1000),
+        "chown_files_per_s": chowned / (total(steps, "ChownDuration") / 1000),
+        "delete_files_per_s": entries / delete_seconds,
+        "users_per_min": 2 * len(uids) / setup_seconds * 60,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the metrics more than tolerance below their baseline."""
+    return [
+        f"{k}: {results[k]:.1f} < {v:.1f} - {tolerance:.0%}"
+        for k, v in baseline.items()
+        if k in results and results[k] < v * (1 - tolerance)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--repos", type=int, default=1, help="Repositories per user")
+    parser.add_argument("--files", type=int, default=2000, help="Files per repository")
+    parser.add_argument("--depth", type=int, default=3, help="Folder nesting")
+    parser.add_argument("--blob-size", type=int, default=4096)
+    parser.add_argument("--commits", type=int, default=5)
+    parser.add_argument(
+        "--cache", choices=["none", "dissociate"], default="none"
+    )
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument(
+        "--staging",
+        action="store_true",
+        help="Clone to local storage, then copy to the EFS folder",
+    )
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="populate-bench-") as tmp:
+        tmp = Path(tmp)
+        efs_root = tmp / "efs"
+        efs_root.mkdir()
+        repos = [
+            make_repo(
+                tmp / "repos",
+                f"repo{i}",
+                args.files,
+                args.depth,
+                args.blob_size,
+                args.commits,
+            )
+            for i in range(args.repos)
+        ]
+
+        # The handler reads its configuration when imported
+        os.environ["EFS_ROOT"] = str(efs_root)
+        if args.staging:
+            os.environ["STAGING_ROOT"] = str(tmp / "staging")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        sys.path[:0] = [
+            str(ROOT / "populate_git_fn"),
+            str(ROOT / "aws_runtime_layer" / "python"),
+        ]
+        import aws_clients
+
+        if os.geteuid() == 0:
+            uids = {f"user{i}": 200001 + i for i in range(args.users)}
+        else:
+            # Only root can give the files away: the users share one home folder,
+            # each setup moving the clones of the previous one to the trash
+            uids = {f"user{i}": os.geteuid() for i in range(args.users)}
+        aws_clients._clients[("sagemaker", ())] = StubSageMaker(uids)
+        if args.latency_ms:
+            add_latency(args.latency_ms / 1000)
+
+        runs = [run_once(efs_root, repos, args, uids) for _ in range(args.iterations)]
+
+    results = {k: statistics.median(run[k] for run in runs) for k in runs[0]}
+    print(json.dumps({k: round(v, 1) for k, v in results.items()}, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif args.baseline.exists():
+        regressions = compare(
+            results, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        for regression in regressions:
+            print(f"Regression {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
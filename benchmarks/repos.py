@@ -0,0 +1,43 @@
+import os
+import subprocess
+from pathlib import Path
+
+
+def git(*args, cwd):
+    subprocess.run(["git", *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+
+
+def make_repo(
+    root: Path, name: str, files: int, depth: int, blob_size: int, commits: int
+) -> Path:
+    """Create the bare repository root/<name>.git and return its path.
+
+    The working tree holds files spread over folders nested depth levels deep,
+    each blob_size bytes of incompressible data. Every one of the commits
+    rewrites a tenth of the files, so history grows with commits.
+    """
+    bare = root / f"{name}.git"
+    if bare.exists():
+        return bare
+    work = root / f"{name}.work"
+    work.mkdir(parents=True)
+    git("init", "-q", cwd=work)
+    git("checkout", "-q", "-b", "main", cwd=work)
+    git("config", "user.email", "bench@example.com", cwd=work)
+    git("config", "user.name", "bench", cwd=work)
+
+    paths = []
+    for i in range(files):
+        folder = Path(*[f"d{(i >> (3 * k)) % 8}" for k in range(depth)])
+        paths.append(folder / f"f{i}.bin")
+    for commit in range(commits):
+        for i, path in enumerate(paths):
+            if commit and i % 10 != commit % 10:
+                continue
+            (work / path).parent.mkdir(parents=True, exist_ok=True)
+            (work / path).write_bytes(os.urandom(blob_size))
+        git("add", "-A", cwd=work)
+        git("commit", "-q", "-m", f"commit {commit}", cwd=work)
+
+    git("clone", "-q", "--bare", str(work), str(bare), cwd=root)
+    return bare
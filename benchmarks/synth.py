@@ -0,0 +1,274 @@
+"""Profile the synthesis of the CDK app and check its templates against snapshots.
+
+    python -m benchmarks.synth [--stacks SageMakerStudioVpc,...] [-c key=value]
+        [--bundling] [--budget 20] [--update-snapshots]
+
+app.py is run in this process, with the context of cdk.json, and reports:
+
+- the import time of the modules, from python -X importtime, rolled up to the
+  repository modules and the aws_cdk packages;
+- the construction time of each stack and construct defined in the repository,
+  nested as built;
+- the construction time of the asset constructs, which includes the Docker
+  bundling of the Lambda functions when --bundling is set;
+- the time of app.synth().
+
+The synthesized templates are then compared with the ones saved in
+benchmarks/snapshots by --update-snapshots, asset hashes left out, and the run
+fails when any differs or has no snapshot, or when the whole synthesis takes
+more than --budget seconds, BUDGET by default. Only the full app is compared:
+with --stacks, the outputs exported to the stacks left out are missing.
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+SNAPSHOTS = Path(__file__).resolve().parent / "snapshots"
+# Seconds the synthesis may take without --bundling: a few times the usual
+# duration, so that only a real regression goes over
+BUDGET = 20
+
+# Constructors timed besides the ones defined in the repository: the assets,
+# bundled when constructed
+ASSET_MODULES = [
+    os.path.join("aws_cdk", "aws_lambda_python", "__init__.py"),
+    os.path.join("aws_cdk", "aws_s3_assets", "__init__.py"),
+]
+
+
+class ConstructTimer:
+    """Time the __init__ of the repository and asset classes with sys.setprofile.
+
+    The profile function runs on every Python call, which slows the synthesis
+    down a little: the absolute times are upper bounds.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.constructs = []
+        self.assets = []
+
+    def _kind(self, code):
+        if code.co_name != "__init__":
+            return None
+        filename = code.co_filename
+        if filename.startswith(str(ROOT)) and "benchmarks" not in filename:
+            return "construct"
+        if any(filename.endswith(k) for k in ASSET_MODULES):
+            return "asset"
+        return None
+
+    def __call__(self, frame, event, arg):
+        if event not in ("call", "return"):
+            return
+        kind = self._kind(frame.f_code)
+        if kind is None:
+            return
+        if event == "call":
+            self.stack.append((frame, time.perf_counter()))
+            return
+        if not self.stack or self.stack[-1][0] is not frame:
+            return
+        _, start = self.stack.pop()
+        instance = frame.f_locals.get("self")
+        try:
+            path = instance.node.path
+        except Exception:
+            # super().__init__ of a construct already being timed
+            return
+        entry = (
+            len(self.stack),
+            path,
+            type(instance).__name__,
+            time.perf_counter() - start,
+        )
+        (self.assets if kind == "asset" else self.constructs).append(entry)
+
+
+def import_times(log):
+    """Roll the python -X importtime log up by repository module and aws_cdk package."""
+    totals = collections.Counter()
+    for line in log.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if not match:
+            continue
+        self_us, name = int(match.group(1)), match.group(4)
+        top = name.split(".")[0]
+        if top == "aws_cdk":
+            key = ".".join(name.split(".")[:2])
+        elif top in ("sm_domain", "sm_user", "sm_common", "sm_roster"):
+            key = name
+        elif top == "jsii":
+            key = "jsii"
+        else:
+            key = "other"
+        totals[key] += self_us / 1e6
+    return totals
+
+
+def normalize(template):
+    """Drop the asset hashes, which change with any file of the assets."""
+    text = json.dumps(template, indent=1, sort_keys=True)
+    text = re.sub(
+        r"AssetParameters[0-9a-f]{64}(S3Bucket|S3VersionKey|ArtifactHash)[0-9A-F]{8}",
+        r"AssetParameters\1",
+        text,
+    )
+    text = re.sub(r"[0-9a-f]{64}", "<hash>", text)
+    return json.loads(text)
+
+
+def changed_resources(snapshot, template):
+    names = set(snapshot.get("Resources", {})) | set(template.get("Resources", {}))
+    changed = sorted(
+        k
+        for k in names
+        if snapshot.get("Resources", {}).get(k) != template.get("Resources", {}).get(k)
+    )
+    for section in ("Parameters", "Outputs", "Conditions"):
+        if snapshot.get(section) != template.get(section):
+            changed.append(section)
+    return changed
+
+
+def check_snapshots(outdir, update):
+    """Compare the templates of the assembly in outdir with the snapshots."""
+    failures = []
+    SNAPSHOTS.mkdir(exist_ok=True)
+    for path in sorted(Path(outdir).glob("*.template.json")):
+        template = normalize(json.loads(path.read_text()))
+        snapshot_path = SNAPSHOTS / path.name
+        if update:
+            snapshot_path.write_text(
+                json.dumps(template, indent=1, sort_keys=True) + "\n"
+            )
+            print(f"Snapshot saved to {snapshot_path}")
+        elif not snapshot_path.exists():
+            # A new stack, or snapshots never saved: nothing to compare with
+            failures.append(f"{path.name}: no snapshot, see --update-snapshots")
+        else:
+            changed = changed_resources(json.loads(snapshot_path.read_text()), template)
+            if changed:
+                failures.append(f"{path.name}: {', '.join(changed)}")
+    return failures
+
+
+def profile_synth(args, log_path):
+    """Run app.py, print where the time went and return the total seconds."""
+    os.chdir(ROOT)
+    sys.path.insert(0, str(ROOT))
+    timer = ConstructTimer()
+    synth_seconds = []
+    start = time.perf_counter()
+    from aws_cdk import core as cdk
+
+    synth = cdk.App.synth
+
+    def timed_synth(self, *a, **kw):
+        synth_start = time.perf_counter()
+        try:
+            return synth(self, *a, **kw)
+        finally:
+            synth_seconds.append(time.perf_counter() - synth_start)
+
+    cdk.App.synth = timed_synth
+    sys.setprofile(timer)
+    try:
+        runpy.run_path(str(ROOT / "app.py"), run_name="__main__")
+    finally:
+        sys.setprofile(None)
+    total = time.perf_counter() - start
+    imports = import_times(Path(log_path).read_text())
+
+    print(f"Imports ({sum(imports.values()):.2f} s, self time)")
+    for name, seconds in imports.most_common(args.top):
+        print(f"  {seconds:8.3f} s  {name}")
+    print("Constructs (inclusive)")
+    # Sorted by path, parents before their children
+    for depth, path, cls, seconds in sorted(timer.constructs, key=lambda k: k[1]):
+        print(f"  {seconds:8.3f} s  {'  ' * depth}{path} ({cls})")
+    print(f"Assets ({sum(k[3] for k in timer.assets):.2f} s)")
+    for _, path, cls, seconds in sorted(timer.assets, key=lambda k: -k[3]):
+        print(f"  {seconds:8.3f} s  {path} ({cls})")
+    print(f"Synth     {sum(synth_seconds):8.3f} s")
+    print(f"Total     {total:8.3f} s")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stacks", default="", help="Stacks to build, all by default")
+    parser.add_argument(
+        "-c", "--context", action="append", default=[], help="key=value context"
+    )
+    parser.add_argument(
+        "--bundling", action="store_true", help="Bundle the Lambda assets with Docker"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=BUDGET,
+        help=f"Maximum seconds for the synthesis, 0 for none (default: {BUDGET})",
+    )
+    parser.add_argument("--update-snapshots", action="store_true")
+    parser.add_argument("--top", type=int, default=15, help="Slowest imports listed")
+    args = parser.parse_args()
+
+    log_path = os.environ.get("SYNTH_IMPORT_LOG")
+    if log_path is not None:
+        total = profile_synth(args, log_path)
+        failures = []
+        if args.stacks:
+            # The outputs exported to the stacks left out are missing
+            print("Snapshots not checked with --stacks")
+        else:
+            failures = check_snapshots(os.environ["CDK_OUTDIR"], args.update_snapshots)
+        for failure in failures:
+            print(f"Snapshot mismatch {failure}")
+        if args.budget and total > args.budget:
+            failures.append("budget")
+            print(f"Over budget: {total:.2f} s > {args.budget:.2f} s")
+        raise SystemExit(1 if failures else 0)
+
+    context = json.loads((ROOT / "cdk.json").read_text()).get("context", {})
+    context.update(k.split("=", 1) for k in args.context)
+    if args.stacks:
+        context["stacks"] = args.stacks
+    if not args.bundling:
+        context["aws:cdk:bundling-stacks"] = []
+
+    # The import times are only written by the interpreter, from its start, to
+    # stderr, and the app context is read by the jsii runtime when it starts:
+    # the synthesis runs in a child process set up for both
+    with tempfile.TemporaryDirectory(prefix="synth-bench-") as tmp:
+        log_path = Path(tmp) / "importtime.log"
+        with open(log_path, "w") as log:
+            child = subprocess.run(
+                [sys.executable, "-X", "importtime", "-m", "benchmarks.synth"]
+                + sys.argv[1:],
+                env=dict(
+                    os.environ,
+                    SYNTH_IMPORT_LOG=str(log_path),
+                    CDK_OUTDIR=str(Path(tmp) / "cdk.out"),
+                    CDK_CONTEXT_JSON=json.dumps(context),
+                ),
+                stderr=log,
+            )
+        for line in log_path.read_text().splitlines(True):
+            if not line.startswith("import time:"):
+                sys.stderr.write(line)
+    raise SystemExit(child.returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,171 @@
-# Function: CFEnableSagemakerProjects
-# Purpose:  Enables Sagemaker Projects
+"""Custom resource enabling SageMaker Projects for the Studio execution roles.
+
+Invoked directly by CloudFormation, not through a provider, so it sends the
+response itself, once, whatever happens.
+"""
+
 import json
-import boto3
-import cfnresponse
-client = boto3.client('sagemaker')
-sc_client = boto3.client('servicecatalog')
-def lambda_handler(event, context):
-    response_status = cfnresponse.SUCCESS
-    execution_role = event['ResourceProperties']['ExecutionRole']
-    
-    if 'RequestType' in event and event['RequestType'] == 'Create':
-        enable_projects(execution_role)
-    cfnresponse.send(event, context, response_status, {}, '')
-    if 'RequestType' in event and event['RequestType'] == 'Delete':
-        disable_projects(execution_role)
-    cfnresponse.send(event, context, response_status, {}, '')
-
-
-def enable_projects(studio_role_arn):
-    # enable Project on account level (accepts portfolio share)
-    response = client.enable_sagemaker_servicecatalog_portfolio()
-    # associate studio role with portfolio
-    response = sc_client.list_accepted_portfolio_shares()
-    portfolio_id = ''
-    for portfolio in response['PortfolioDetails']:
-        if portfolio['ProviderName'] == 'Amazon SageMaker':
-            portfolio_id = portfolio['Id']
-    response = sc_client.associate_principal_with_portfolio(
-        PortfolioId=portfolio_id,
-        PrincipalARN=studio_role_arn,
-        PrincipalType='IAM'
+import logging
+import time
+import traceback
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+
+PROVIDER_NAME = "Amazon SageMaker"
+PHYSICAL_ID = "sagemaker-projects"
+MAX_WORKERS = 8
+
+# Found once per execution environment, the portfolio share does not change
+_portfolio_id = None
+
+
+def on_event(event, context):
+    data = {}
+    try:
+        request_type = event["RequestType"]
+        if request_type in ("Create", "Update"):
+            data = on_enable(event)
+        elif request_type == "Delete":
+            data = on_disable(event)
+        else:
+            raise Exception(f"Invalid request type: {request_type}")
+    except Exception as e:
+        traceback.print_exc()
+        send_response(event, context, "FAILED", {}, str(e))
+        return
+    send_response(event, context, "SUCCESS", data)
+
+
+def send_response(event, context, status, data, reason=""):
+    body = json.dumps(
+        {
+            "Status": status,
+            "Reason": reason or f"See CloudWatch log stream {context.log_stream_name}",
+            # Keeping the physical id of an existing resource on Update, or it
+            # would be deleted, and projects disabled, once the stack updated
+            "PhysicalResourceId": event.get("PhysicalResourceId", PHYSICAL_ID),
+            "StackId": event["StackId"],
+            "RequestId": event["RequestId"],
+            "LogicalResourceId": event["LogicalResourceId"],
+            "Data": data,
+        }
+    ).encode("utf8")
+    request = urllib.request.Request(
+        event["ResponseURL"],
+        data=body,
+        method="PUT",
+        headers={"Content-Type": "", "Content-Length": str(len(body))},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        logging.info("**Response sent: %s", response.status)
+
+
+def principals(props):
+    """Return the ARNs of the execution roles listed in the resource properties."""
+    if props is None:
+        return set()
+    # Single role of the resources created before ExecutionRoles
+    if "ExecutionRole" in props:
+        return {props["ExecutionRole"]}
+    return set(props.get("ExecutionRoles", []))
+
+
+def portfolio_id():
+    """Return the id of the SageMaker portfolio shared with the account, or None."""
+    global _portfolio_id
+    if _portfolio_id is None:
+        paginator = aws_clients.client("servicecatalog").get_paginator(
+            "list_accepted_portfolio_shares"
+        )
+        for page in paginator.paginate():
+            for portfolio in page["PortfolioDetails"]:
+                if portfolio["ProviderName"] == PROVIDER_NAME:
+                    _portfolio_id = portfolio["Id"]
+                    return _portfolio_id
+    return _portfolio_id
+
+
+def associated_principals(portfolio):
+    paginator = aws_clients.client("servicecatalog").get_paginator(
+        "list_principals_for_portfolio"
+    )
+    return {
+        principal["PrincipalARN"]
+        for page in paginator.paginate(PortfolioId=portfolio)
+        for principal in page["Principals"]
+    }
+
+
+def _for_each(method, portfolio, arns):
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        list(
+            pool.map(
+                lambda arn: method(
+                    PortfolioId=portfolio, PrincipalARN=arn, PrincipalType="IAM"
+                ),
+                sorted(arns),
+            )
+        )
+
+
+def on_enable(event):
+    """Enable projects and bring the principals of the portfolio in line with
+    the execution roles: new ones are associated, the ones dropped from the
+    properties since the last update are disassociated."""
+    timings = {}
+    start = time.monotonic()
+    sc_client = aws_clients.client("servicecatalog")
+    # Accepts the portfolio share at the account level, a no-op once done
+    aws_clients.client("sagemaker").enable_sagemaker_servicecatalog_portfolio()
+    timings["EnableSeconds"] = round(time.monotonic() - start, 2)
+
+    start = time.monotonic()
+    portfolio = portfolio_id()
+    if portfolio is None:
+        raise Exception(f"No portfolio shared by {PROVIDER_NAME}")
+    existing = associated_principals(portfolio)
+    timings["ListSeconds"] = round(time.monotonic() - start, 2)
+
+    wanted = principals(event["ResourceProperties"])
+    dropped = principals(event.get("OldResourceProperties")) - wanted
+    start = time.monotonic()
+    _for_each(
+        sc_client.associate_principal_with_portfolio, portfolio, wanted - existing
+    )
+    _for_each(
+        sc_client.disassociate_principal_from_portfolio, portfolio, dropped & existing
+    )
+    timings["AssociateSeconds"] = round(time.monotonic() - start, 2)
+
+    logging.info("**SageMaker projects enabled for %s roles", len(wanted))
+    return dict(
+        timings,
+        PortfolioId=portfolio,
+        Associated=len(wanted - existing),
+        AlreadyAssociated=len(wanted & existing),
+        Disassociated=len(dropped & existing),
+    )
+
+
+def on_disable(event):
+    timings = {}
+    start = time.monotonic()
+    portfolio = portfolio_id()
+    # Nothing was associated if the share was never accepted
+    existing = associated_principals(portfolio) if portfolio else set()
+    timings["ListSeconds"] = round(time.monotonic() - start, 2)
+
+    removed = principals(event["ResourceProperties"]) & existing
+    start = time.monotonic()
+    _for_each(
+        aws_clients.client("servicecatalog").disassociate_principal_from_portfolio,
+        portfolio,
+        removed,
     )
+    timings["AssociateSeconds"] = round(time.monotonic() - start, 2)
 
-def disable_projects(studio_role_arn):
-    # disable Project on account level (accepts portfolio share)
-    response = client.disable_sagemaker_servicecatalog_portfolio()
-    # dis-associate studio role with portfolio
-    response = sc_client.list_accepted_portfolio_shares()
-    portfolio_id = ''
-    for portfolio in response['PortfolioDetails']:
-        if portfolio['ProviderName'] == 'Amazon SageMaker':
-            portfolio_id = portfolio['Id']
-    response = sc_client.disassociate_principal_with_portfolio(
-        PortfolioId=portfolio_id,
-        PrincipalARN=studio_role_arn,
-        PrincipalType='IAM'
-    )
\ No newline at end of file
+    aws_clients.client("sagemaker").disable_sagemaker_servicecatalog_portfolio()
+    logging.info("**SageMaker projects disabled")
+    return dict(timings, Disassociated=len(removed))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Synthesize the stacks of many Studio domains from an inventory file.
+
+    python fleet.py fleet.yaml [--outdir cdk.out.fleet] [--jobs 8] [--only name,...]
+
+The inventory lists the domains with the account and region they are deployed
+to, and the context of each, on top of the one shared by all:
+
+    context:
+      usage_report: true
+    domains:
+      - namespace: research-dev
+        account: "111111111111"
+        region: eu-west-1
+      - namespace: finance-prod
+        account: "222222222222"
+        region: us-east-1
+        context:
+          async_mode: true
+          project_roles: ["arn:aws:iam::222222222222:role/finance-ds"]
+
+Each domain is synthesized by app.py, with the namespace prefixing its stacks
+and exports, to its own cloud assembly in <outdir>/<namespace>:
+
+    cdk deploy --app cdk.out.fleet/research-dev --all
+
+The domains are synthesized by --jobs processes at once. The Lambda bundles
+only depend on the sources: the first domain is synthesized alone, and its
+bundles hard-linked into the assembly of every other domain, which then skips
+the bundling.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+# Assets of the assemblies synthesized so far, shared by the next ones
+ASSET_STORE = ".assets"
+
+
+def load_inventory(path: str) -> dict:
+    text = Path(path).read_text()
+    if path.endswith(".json"):
+        return json.loads(text)
+    import yaml
+
+    return yaml.safe_load(text)
+
+
+def domain_contexts(inventory: dict) -> list:
+    """Return the app context of every domain of the inventory, in order.
+
+    Contexts are merged from cdk.json, the context of the inventory and the
+    one of the domain. The SageMaker Projects roles are named: unless set
+    otherwise, only the first domain of each account creates them.
+    """
+    base = json.loads((ROOT / "cdk.json").read_text()).get("context", {})
+    base.update(inventory.get("context") or {})
+    contexts = []
+    accounts = set()
+    for domain in inventory["domains"]:
+        context = dict(base, **(domain.get("context") or {}))
+        context.update(
+            (k, str(domain[k]))
+            for k in ("namespace", "account", "region")
+            if k in domain
+        )
+        if "service_catalog_roles" not in context:
+            context["service_catalog_roles"] = context.get("account") not in accounts
+        accounts.add(context.get("account"))
+        contexts.append(context)
+    names = [k["namespace"] for k in contexts]
+    duplicates = {k for k in names if names.count(k) > 1}
+    if duplicates:
+        raise ValueError(f"Namespaces listed more than once: {sorted(duplicates)}")
+    return contexts
+
+
+def _link_assets(source: Path, target: Path):
+    """Hard-link the folder assets of source missing from target.
+
+    The folders, Lambda bundles and the like, are linked under a temporary
+    name and renamed, so that assemblies synthesized at the same time can
+    share the same target. File assets are cheap to stage again.
+    """
+    target.mkdir(parents=True, exist_ok=True)
+    for entry in source.iterdir():
+        if not entry.name.startswith("asset.") or not entry.is_dir():
+            continue
+        if (target / entry.name).exists():
+            continue
+        partial = target / f".{entry.name}.{os.getpid()}.{threading.get_ident()}"
+        shutil.copytree(entry, partial, symlinks=True, copy_function=os.link)
+        try:
+            os.rename(partial, target / entry.name)
+        except OSError:
+            # Linked by another assembly in the meantime
+            shutil.rmtree(partial)
+
+
+def synth_domain(context: dict, outdir: Path) -> dict:
+    """Run app.py for the domain of context and return how it went."""
+    assembly = outdir / context["namespace"]
+    store = outdir / ASSET_STORE
+    if store.exists():
+        _link_assets(store, assembly)
+    start = time.perf_counter()
+    # The context is read by the jsii runtime when it starts, each domain needs
+    # its own process
+    child = subprocess.run(
+        [sys.executable, str(ROOT / "app.py")],
+        cwd=ROOT,
+        env=dict(
+            os.environ,
+            CDK_OUTDIR=str(assembly),
+            CDK_CONTEXT_JSON=json.dumps(context),
+        ),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+    if child.returncode == 0:
+        _link_assets(assembly, store)
+    return {
+        "namespace": context["namespace"],
+        "assembly": str(assembly),
+        "seconds": round(seconds, 2),
+        "returncode": child.returncode,
+        "output": child.stdout,
+    }
+
+
+def synth_fleet(contexts: list, outdir: Path, jobs: int) -> list:
+    if not contexts:
+        return []
+    # The first domain fills the asset store for the others
+    results = [synth_domain(contexts[0], outdir)]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results += pool.map(lambda k: synth_domain(k, outdir), contexts[1:])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inventory", help="YAML or JSON inventory file")
+    parser.add_argument("--outdir", default="cdk.out.fleet")
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="Domains synthesized at once"
+    )
+    parser.add_argument(
+        "--only", default="", help="Namespaces to synthesize, all by default"
+    )
+    args = parser.parse_args()
+
+    contexts = domain_contexts(load_inventory(args.inventory))
+    if args.only:
+        only = {k.strip() for k in args.only.split(",")}
+        contexts = [k for k in contexts if k["namespace"] in only]
+    outdir = Path(args.outdir).resolve()
+
+    start = time.perf_counter()
+    results = synth_fleet(contexts, outdir, args.jobs)
+    for result in results:
+        if result["returncode"]:
+            sys.stderr.write(result.pop("output"))
+        else:
+            result.pop("output")
+        print(json.dumps(result))
+    failed = [k for k in results if k["returncode"]]
+    print(
+        f"{len(results)} domains synthesized in {time.perf_counter() - start:.1f} s,"
+        f" {len(failed)} failed"
+    )
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+import json
+import os
+import stat
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import PurePosixPath
+
+from no_follow import REFUSED, open_folder, open_root, remove_entry
+from s3_archive import parse_s3_uri
+
+# Size of each ranged GET, objects downloaded at the same time and ranges in
+# flight over all of them
+CHUNK_SIZE = 16 * 1024 * 1024
+MAX_OBJECTS = 8
+MAX_RANGES = 32
+# Objects downloaded between two saves of the manifest
+CHECKPOINT_EVERY = 100
+# Files of a folder linked by a single task, with the folder opened once
+LINK_BATCH = 64
+
+# Folder of the user homes the datasets are exposed in
+HOME_FOLDER = "datasets"
+HARDLINK = "hardlink"
+SYMLINK = "symlink"
+
+
+def load_manifest(datasets_root, name):
+    """Return the objects cached so far, by key relative to the dataset prefix."""
+    try:
+        return json.loads((datasets_root / f"{name}.json").read_text())
+    except FileNotFoundError:
+        return None
+
+
+def _save_manifest(datasets_root, name, manifest):
+    path = datasets_root / f"{name}.json"
+    partial = path.with_name(f".{path.name}.partial")
+    partial.write_text(json.dumps(manifest))
+    os.replace(partial, path)
+
+
+def _list_objects(client, bucket, prefix):
+    for page in client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, Prefix=prefix
+    ):
+        for obj in page.get("Contents", []):
+            relative = obj["Key"][len(prefix) :].lstrip("/")
+            parts = PurePosixPath(relative).parts
+            # Skip the folder markers, and keys that would escape the cache
+            if not relative or obj["Key"].endswith("/") or ".." in parts:
+                continue
+            yield relative, obj
+
+
+def _fetch_range(client, bucket, obj, fd, start, end):
+    response = client.get_object(
+        Bucket=bucket,
+        Key=obj["Key"],
+        Range=f"bytes={start}-{end}",
+        IfMatch=obj["ETag"],
+    )
+    os.pwrite(fd, response["Body"].read(), start)
+
+
+def _download(client, bucket, obj, path, ranges):
+    """Download obj to path with parallel ranged GETs, all pinned to its ETag.
+
+    The object is written next to path and renamed once complete, so readers
+    only ever see whole files.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f".{path.name}.partial")
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        size = obj["Size"]
+        os.ftruncate(fd, size)
+        futures = [
+            ranges.submit(
+                _fetch_range,
+                client,
+                bucket,
+                obj,
+                fd,
+                start,
+                min(start + CHUNK_SIZE, size) - 1,
+            )
+            for start in range(0, size, CHUNK_SIZE)
+        ]
+        for future in futures:
+            future.result()
+    finally:
+        os.close(fd)
+    # Read-only for the users, whose homes link to the same inode
+    os.chmod(partial, 0o444)
+    os.replace(partial, path)
+    return obj["Size"]
+
+
+def sync_dataset(client, datasets_root, name, uri, deadline):
+    """Bring the cache of the dataset at uri (an s3:// prefix) up to date.
+
+    Only the objects whose ETag differs from the manifest are downloaded, and
+    the files of the objects gone from S3 are deleted. Stops starting new
+    downloads at deadline (a time.monotonic() value), the next call resumes:
+    only the downloads already started, MAX_OBJECTS at most, run past it.
+    Returns counters and whether the cache is complete.
+    """
+    bucket, prefix = parse_s3_uri(uri)
+    target = datasets_root / name
+    manifest = load_manifest(datasets_root, name) or {}
+    stats = {"downloaded": 0, "deleted": 0, "unchanged": 0, "failed": 0, "bytes": 0}
+    stats["complete"] = True
+
+    listed = set()
+    in_flight = {}
+
+    def collect(done):
+        for future in done:
+            relative, obj = in_flight.pop(future)
+            try:
+                stats["bytes"] += future.result()
+            except Exception:
+                # e.g. the object changed during the download, retried next time
+                traceback.print_exc()
+                stats["failed"] += 1
+                stats["complete"] = False
+                continue
+            stats["downloaded"] += 1
+            manifest[relative] = {"etag": obj["ETag"], "size": obj["Size"]}
+            if stats["downloaded"] % CHECKPOINT_EVERY == 0:
+                _save_manifest(datasets_root, name, manifest)
+
+    with ThreadPoolExecutor(max_workers=MAX_RANGES) as ranges, ThreadPoolExecutor(
+        max_workers=MAX_OBJECTS
+    ) as objects:
+        for relative, obj in _list_objects(client, bucket, prefix):
+            listed.add(relative)
+            if manifest.get(relative, {}).get("etag") == obj["ETag"]:
+                stats["unchanged"] += 1
+                continue
+            # No more than MAX_OBJECTS submitted at a time: nothing waits in
+            # the queue of the pool, and no download starts past deadline
+            while len(in_flight) >= MAX_OBJECTS:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            if time.monotonic() > deadline:
+                stats["complete"] = False
+                continue
+            future = objects.submit(
+                _download, client, bucket, obj, target / relative, ranges
+            )
+            in_flight[future] = (relative, obj)
+        collect(list(in_flight))
+
+    for relative in set(manifest) - listed:
+        try:
+            (target / relative).unlink()
+        except FileNotFoundError:
+            pass
+        del manifest[relative]
+        stats["deleted"] += 1
+
+    target.mkdir(parents=True, exist_ok=True)
+    _save_manifest(datasets_root, name, manifest)
+    return stats
+
+
+def _link_files(home_fd, folder, files, shared, uid, gid):
+    """Hard link the shared files of one folder, unless the user has made them
+    their own. Returns the outcome of each file."""
+    try:
+        # Nothing is linked through a symlink of the user
+        folder_fd = open_folder(home_fd, folder.parts)
+    except OSError as err:
+        if err.errno not in REFUSED:
+            raise
+        return ["kept"] * len(files)
+    try:
+        return [_link_file(shared / k, folder_fd, k.name) for k in files]
+    finally:
+        os.close(folder_fd)
+
+
+def _link_file(shared, folder_fd, name):
+    try:
+        st = os.stat(name, dir_fd=folder_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        st = None
+    if st is not None:
+        if os.path.samestat(st, os.stat(shared)):
+            return "unchanged"
+        if st.st_uid != 0 or not stat.S_ISREG(st.st_mode):
+            # Not one of the links made here
+            return "kept"
+    partial = f".{name}.link"
+    remove_entry(partial, folder_fd)
+    os.link(shared, partial, dst_dir_fd=folder_fd)
+    # Replaces a link of an older version, never follows it
+    os.replace(partial, name, src_dir_fd=folder_fd, dst_dir_fd=folder_fd)
+    return "linked"
+
+
+def link_dataset(datasets_root, name, home_folder, uid, mode=HARDLINK, gid=-1):
+    """Expose the cached dataset as datasets/<name> in home_folder.
+
+    With SYMLINK, a single symbolic link to the cache is created. It only
+    resolves where the cache is mounted at the same path, which is not the
+    case in the Studio apps: they only see the home folder of their user.
+    With HARDLINK, the folders are created for the user and every file is a
+    hard link to the read-only copy of the cache: no data is copied, and
+    refreshed or removed files are relinked or unlinked on the next update.
+    Paths of the home are never followed through a symlink, the files below
+    one are counted as kept. Returns counters, or None if the dataset was
+    never synced.
+    """
+    manifest = load_manifest(datasets_root, name)
+    if manifest is None:
+        return None
+    shared = datasets_root / name
+    stats = {"linked": 0, "unchanged": 0, "kept": 0, "removed": 0, "folders": 0}
+
+    home_fd = open_root(home_folder)
+    try:
+        folders = [PurePosixPath(HOME_FOLDER)]
+        if mode == HARDLINK:
+            folders += sorted(
+                {PurePosixPath(HOME_FOLDER, name, k).parent for k in manifest}
+            )
+        for folder in folders:
+            created = []
+            try:
+                os.close(open_folder(home_fd, folder.parts, uid, gid, created=created))
+            except OSError as err:
+                if err.errno not in REFUSED:
+                    raise
+            stats["folders"] += len(created)
+
+        if mode == SYMLINK:
+            _link_folder(home_fd, shared, name, uid, gid, stats)
+            return stats
+
+        # Files grouped by folder, in batches that each open their folder once
+        by_folder = {}
+        for relative in sorted(manifest):
+            path = PurePosixPath(HOME_FOLDER, name, relative)
+            by_folder.setdefault(path.parent, []).append(PurePosixPath(relative))
+        batches = [
+            (folder, files[i : i + LINK_BATCH])
+            for folder, files in by_folder.items()
+            for i in range(0, len(files), LINK_BATCH)
+        ]
+        with ThreadPoolExecutor(max_workers=MAX_RANGES) as pool:
+            results = pool.map(
+                lambda k: _link_files(home_fd, k[0], k[1], shared, uid, gid), batches
+            )
+            for outcomes in results:
+                for outcome in outcomes:
+                    stats[outcome] += 1
+
+        _remove_stale_links(home_fd, name, manifest, stats)
+    finally:
+        os.close(home_fd)
+    return stats
+
+
+def _link_folder(home_fd, shared, name, uid, gid, stats):
+    try:
+        folder_fd = open_folder(home_fd, [HOME_FOLDER])
+    except OSError as err:
+        if err.errno not in REFUSED:
+            raise
+        stats["kept"] += 1
+        return
+    try:
+        try:
+            st = os.stat(name, dir_fd=folder_fd, follow_symlinks=False)
+        except FileNotFoundError:
+            st = None
+        if st is None:
+            os.symlink(shared, name, target_is_directory=True, dir_fd=folder_fd)
+            os.chown(name, uid, gid, dir_fd=folder_fd, follow_symlinks=False)
+            stats["linked"] += 1
+        elif not stat.S_ISLNK(st.st_mode):
+            stats["kept"] += 1
+    finally:
+        os.close(folder_fd)
+
+
+def _remove_stale_links(home_fd, name, manifest, stats):
+    # Drop the links to the files since removed from the dataset
+    try:
+        target_fd = open_folder(home_fd, [HOME_FOLDER, name])
+    except OSError as err:
+        if err.errno not in REFUSED:
+            raise
+        return
+    try:
+        # fwalk does not follow the symlinks below the target either
+        for folder, _, files, folder_fd in os.fwalk(dir_fd=target_fd):
+            for file_name in files:
+                relative = os.path.normpath(os.path.join(folder, file_name))
+                if relative in manifest:
+                    continue
+                st = os.stat(file_name, dir_fd=folder_fd, follow_symlinks=False)
+                if st.st_uid == 0:
+                    os.unlink(file_name, dir_fd=folder_fd)
+                    stats["removed"] += 1
+    finally:
+        os.close(target_fd)
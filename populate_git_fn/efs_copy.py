@@ -0,0 +1,102 @@
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+# Each file written to EFS costs several NFS round trips (create, setattr,
+# write, close): many writers in parallel keep the volume busy.
+MAX_WORKERS = 32
+
+
+def _make_folder(path, mode, uid, gid):
+    os.mkdir(path, 0o700)
+    os.chown(path, uid=uid, gid=gid)
+    os.chmod(path, stat.S_IMODE(mode))
+
+
+def _copy_file(source, target, uid, gid):
+    st = os.lstat(source)
+    with open(source, "rb") as src:
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with open(fd, "wb") as dst:
+            # Owned by the user from the start, no ownership pass afterwards
+            os.fchown(fd, uid, gid)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            dst.flush()
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            # Keeps the git index stat information close to the files
+            os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return st.st_size
+
+
+def _copy_link(source, target, uid, gid):
+    os.symlink(os.readlink(source), target)
+    os.chown(target, uid=uid, gid=gid, follow_symlinks=False)
+
+
+def copy_tree(source, target, uid, gid=-1, max_workers=MAX_WORKERS):
+    """Copy the local folder source to target, which must not exist yet.
+
+    Folders are created one depth level at a time and files copied by a pool
+    of threads, everything owned by uid as it is written. The copy is made in
+    a hidden folder next to target and renamed at the end, so target only
+    ever appears complete. Returns the number of folders, files, links and
+    bytes written.
+    """
+    partial = target.with_name(f".{target.name}.partial")
+    if os.path.lexists(partial):
+        # Left behind by an interrupted copy
+        shutil.rmtree(partial)
+
+    # Local storage: a single sequential walk is fast enough
+    folders_by_depth = {0: [(".", os.lstat(source).st_mode)]}
+    files = []
+    links = []
+    to_visit = [(os.fspath(source), ".", 0)]
+    while to_visit:
+        folder, relative, depth = to_visit.pop()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                path = os.path.join(relative, entry.name)
+                if entry.is_symlink():
+                    links.append(path)
+                elif entry.is_dir():
+                    mode = entry.stat(follow_symlinks=False).st_mode
+                    folders_by_depth.setdefault(depth + 1, []).append((path, mode))
+                    to_visit.append((entry.path, path, depth + 1))
+                else:
+                    files.append(path)
+
+    stats = {"folders": 0, "files": len(files), "links": len(links), "bytes": 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for depth in sorted(folders_by_depth):
+            folders = folders_by_depth[depth]
+            list(
+                pool.map(
+                    lambda k: _make_folder(
+                        os.path.normpath(os.path.join(partial, k[0])), k[1], uid, gid
+                    ),
+                    folders,
+                )
+            )
+            stats["folders"] += len(folders)
+
+        stats["bytes"] = sum(
+            pool.map(
+                lambda k: _copy_file(
+                    os.path.join(source, k), os.path.join(partial, k), uid, gid
+                ),
+                files,
+            )
+        )
+        list(
+            pool.map(
+                lambda k: _copy_link(
+                    os.path.join(source, k), os.path.join(partial, k), uid, gid
+                ),
+                links,
+            )
+        )
+
+    os.rename(partial, target)
+    return stats
@@ -0,0 +1,24 @@
+import os
+from pathlib import Path
+
+# Overridden by the offline benchmarks, which run against a local folder
+EFS_ROOT = Path(os.environ.get("EFS_ROOT", "/mnt/efs"))
+
+# Reserved folders on the Studio EFS. Their names can never collide with the
+# numeric UID folders of the users.
+# One bare mirror per repository URL
+GIT_CACHE_ROOT = EFS_ROOT / ".git-cache"
+# Folders waiting to be deleted, grouped by user UID
+TRASH_ROOT = EFS_ROOT / ".trash"
+# Home folders of the deleted users with the Archive delete policy, by UID
+ARCHIVE_ROOT = EFS_ROOT / ".archive"
+# ETag of the archive each user home was last seeded from
+SEED_ARCHIVE_STATE_ROOT = EFS_ROOT / ".seed-archive"
+# Progress of the requests handled by the asynchronous provider
+JOBS_ROOT = EFS_ROOT / ".jobs"
+# Versions of the template applied to every user home, and what each home got
+HOME_TEMPLATE_ROOT = EFS_ROOT / ".home-template"
+# Read-only copies of the S3 datasets, linked into the user homes
+DATASETS_ROOT = EFS_ROOT / ".datasets"
+# Folder listings and totals of the last usage scan, per user UID
+USAGE_ROOT = EFS_ROOT / ".usage"
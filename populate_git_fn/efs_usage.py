@@ -0,0 +1,166 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Folders listed at the same time, over all the homes of a batch
+MAX_WORKERS = 64
+# Folders listed between two checks of the deadline
+CHUNK_SIZE = 4 * MAX_WORKERS
+# A home is walked in full again after this many seconds, see scan_homes()
+FULL_SCAN_AFTER = 24 * 3600
+
+
+def _blocks(st):
+    return st.st_blocks * 512
+
+
+def load_usage(usage_root, uid):
+    """Return what the last scan of the home of uid found, or None."""
+    try:
+        return json.loads((usage_root / f"{uid}.json").read_text())
+    except FileNotFoundError:
+        return None
+
+
+def _save_usage(usage_root, uid, usage):
+    usage_root.mkdir(parents=True, exist_ok=True)
+    path = usage_root / f"{uid}.json"
+    partial = path.with_name(f".{path.name}.partial")
+    partial.write_text(json.dumps(usage))
+    os.replace(partial, path)
+
+
+def _scan_folder(path, mtime, cached):
+    """Return the totals of the entries directly in the folder at path, its
+    subfolders with their mtime, and whether the cached listing was reused.
+
+    Adding, removing or renaming an entry updates the mtime of its folder: when
+    it is unchanged, the cached totals still hold and only the subfolders are
+    looked at again, with one stat each instead of a listing plus a stat per
+    entry.
+    """
+    if cached is not None and cached["mtime"] == mtime:
+        subfolders = []
+        for name in cached["dirs"]:
+            try:
+                st = os.lstat(os.path.join(path, name))
+            except FileNotFoundError:
+                continue
+            subfolders.append((name, st.st_mtime_ns))
+        return cached, subfolders, True
+
+    record = {"mtime": mtime, "bytes": 0, "shared_bytes": 0, "inodes": 0, "dirs": []}
+    subfolders = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                record["inodes"] += 1
+                if entry.is_dir(follow_symlinks=False):
+                    record["bytes"] += _blocks(st)
+                    record["dirs"].append(entry.name)
+                    subfolders.append((entry.name, st.st_mtime_ns))
+                elif st.st_nlink > 1 and st.st_uid == 0:
+                    # Hard link to the home template or a shared dataset, the
+                    # data is stored once for all the users
+                    record["shared_bytes"] += _blocks(st)
+                else:
+                    record["bytes"] += _blocks(st)
+    except FileNotFoundError:
+        # Removed since its parent was listed
+        return None, [], False
+    return record, subfolders, False
+
+
+def scan_homes(efs_root, usage_root, uids, deadline=None, max_workers=MAX_WORKERS):
+    """Total the bytes and inodes of the home folders of uids.
+
+    The homes are walked together breadth first, folders listed in parallel.
+    The listing of every folder is cached under usage_root with its mtime, and
+    reused by the next scan while the mtime is unchanged. A file rewritten in
+    place does not touch the mtime of its folder though: its new size is only
+    seen once the home is walked in full again, every FULL_SCAN_AFTER seconds.
+
+    No folder is listed past deadline (a time.monotonic() value). The walk of
+    the homes not finished by then is saved as their "resume" state, next to
+    the totals of their last complete scan, and the next scan carries on from
+    there. Returns the usage of each uid, also saved under usage_root, and the
+    number of folders listed and reused and of homes left unfinished.
+    """
+    now = time.time()
+    cached = {}
+    usage = {}
+    previous_usage = {}
+    pending = deque()
+    for uid in uids:
+        previous = load_usage(usage_root, uid) or {}
+        resume = previous.pop("resume", None)
+        previous_usage[uid] = previous
+        if resume is not None:
+            # Cut short by the deadline of an earlier run
+            full_scan = resume["full_scan_at"] == resume["started_at"]
+            cached[uid] = {} if full_scan else previous.get("folders", {})
+            usage[uid] = resume
+            pending.extend(
+                (uid, relative, mtime) for relative, mtime in resume["pending"]
+            )
+            continue
+        full_scan = now - previous.get("full_scan_at", 0) > FULL_SCAN_AFTER
+        cached[uid] = {} if full_scan else previous.get("folders", {})
+        usage[uid] = {
+            "started_at": now,
+            "full_scan_at": now if full_scan else previous["full_scan_at"],
+            "folders": {},
+        }
+        try:
+            mtime = os.lstat(efs_root / str(uid)).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        pending.append((uid, ".", mtime))
+
+    stats = {"listed": 0, "reused": 0, "unfinished": 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            chunk = [pending.popleft() for _ in range(min(len(pending), CHUNK_SIZE))]
+            results = pool.map(
+                lambda k: _scan_folder(
+                    os.path.join(efs_root, str(k[0]), k[1]),
+                    k[2],
+                    cached[k[0]].get(k[1]),
+                ),
+                chunk,
+            )
+            for (uid, relative, _), (record, subfolders, reused) in zip(chunk, results):
+                if record is None:
+                    continue
+                usage[uid]["folders"][relative] = record
+                stats["reused" if reused else "listed"] += 1
+                pending.extend(
+                    (uid, os.path.normpath(os.path.join(relative, name)), mtime)
+                    for name, mtime in subfolders
+                )
+
+    unfinished = {uid: [] for uid in uids}
+    for uid, relative, mtime in pending:
+        unfinished[uid].append([relative, mtime])
+    for uid in uids:
+        if unfinished[uid]:
+            usage[uid]["pending"] = unfinished[uid]
+            # The totals of the last complete scan are still reported
+            usage[uid] = dict(previous_usage[uid], resume=usage[uid])
+            stats["unfinished"] += 1
+        else:
+            usage[uid].pop("pending", None)
+            folders = usage[uid]["folders"].values()
+            usage[uid].update(
+                scanned_at=usage[uid].pop("started_at"),
+                bytes=sum(k["bytes"] for k in folders),
+                shared_bytes=sum(k["shared_bytes"] for k in folders),
+                inodes=sum(k["inodes"] for k in folders),
+            )
+        _save_usage(usage_root, uid, usage[uid])
+    return usage, stats
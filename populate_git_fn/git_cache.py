@@ -0,0 +1,75 @@
+import fcntl
+import hashlib
+import shutil
+import time
+from contextlib import contextmanager
+
+from git_cli import clone, git
+
+# A mirror fetched less than MAX_AGE seconds ago is considered fresh, so a batch
+# of users provisioned together triggers a single fetch from the upstream.
+MAX_AGE = 300
+
+
+@contextmanager
+def locked(lock_path):
+    """Hold an exclusive lock on lock_path, shared by all the Lambda instances
+    mounting the same EFS volume."""
+    with open(lock_path, "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def mirror_path(cache_root, git_repo):
+    digest = hashlib.sha256(git_repo.encode("utf8")).hexdigest()[:16]
+    return cache_root / f"{digest}.git"
+
+
+def refresh_mirror(cache_root, git_repo, max_age=MAX_AGE):
+    """Create or update the bare mirror of git_repo in cache_root and return its path."""
+    cache_root.mkdir(parents=True, exist_ok=True)
+    mirror = mirror_path(cache_root, git_repo)
+    stamp = mirror.with_suffix(".fetched")
+
+    with locked(mirror.with_suffix(".lock")):
+        if stamp.exists() and time.time() - stamp.stat().st_mtime < max_age:
+            print(f"Using cached mirror {mirror}")
+            return mirror
+
+        if mirror.exists():
+            print(f"Refreshing mirror {mirror}")
+            git("fetch", "--prune", "origin", cwd=mirror)
+        else:
+            print(f"Creating mirror {mirror}")
+            # Clone next to the final location and rename, so an interrupted
+            # clone never leaves a half populated mirror behind
+            partial = mirror.with_suffix(".partial")
+            shutil.rmtree(partial, ignore_errors=True)
+            clone(git_repo, partial, mirror=True)
+            # Allow partial and shallow clones over file://
+            git("config", "uploadpack.allowFilter", "true", cwd=partial)
+            partial.rename(mirror)
+        stamp.touch()
+
+    return mirror
+
+
+def clone_from_mirror(mirror, git_repo, repo_folder, mode, **git_options):
+    """Clone repo_folder from the local mirror without contacting the upstream.
+
+    With mode "dissociate", the only one, the clone receives its own copy of
+    the objects, and origin points back to git_repo. The clone cannot borrow
+    them through git alternates: the mirror path only exists where the
+    Lambda functions mount the volume, not in the Studio apps, and a prune
+    of the mirror could drop objects the clone still needs.
+    """
+    if mode != "dissociate":
+        raise ValueError(f"Invalid git cache mode: {mode}")
+    # file:// goes through the pack protocol: no hardlinks into the cache, and
+    # depth/filter are honoured
+    clone(mirror.as_uri(), repo_folder, **git_options)
+
+    git("remote", "set-url", "origin", git_repo, cwd=repo_folder)
@@ -0,0 +1,54 @@
+from git_cli import GitError, git
+
+UP_TO_DATE = "up-to-date"
+FAST_FORWARDED = "fast-forwarded"
+DIVERGED = "diverged"
+
+
+def open_clone(repo_folder, git_repo):
+    """Return repo_folder if it holds a clone of git_repo, else None."""
+    if not (repo_folder / ".git").is_dir():
+        return None
+    try:
+        origin = git("remote", "get-url", "origin", cwd=repo_folder)
+    except GitError:
+        # Not a repository, or no origin
+        return None
+    if origin.rstrip("/") != git_repo.rstrip("/"):
+        return None
+    return repo_folder
+
+
+def fast_forward(repo_folder, branch="", source="origin"):
+    """Bring the checked out branch of the clone in repo_folder up to date with source.
+
+    Only the objects missing locally are fetched, and nothing is fetched at all
+    when the remote branch already matches HEAD. The working tree is left
+    untouched if the local branch has diverged, the user has switched to
+    another branch or the merge would overwrite local changes.
+    Returns UP_TO_DATE, FAST_FORWARDED or DIVERGED, and whether anything was
+    fetched: the fetch writes objects and refs, whatever the outcome.
+    """
+    try:
+        active_branch = git("symbolic-ref", "--short", "HEAD", cwd=repo_folder)
+    except GitError:
+        # Detached HEAD
+        return DIVERGED, False
+    if branch not in ("", active_branch):
+        return DIVERGED, False
+    branch = active_branch
+    tracking_ref = f"refs/remotes/origin/{branch}"
+
+    remote_head = git("ls-remote", source, f"refs/heads/{branch}", cwd=repo_folder)
+    if remote_head.split("\t")[0] == git("rev-parse", "HEAD", cwd=repo_folder):
+        return UP_TO_DATE, False
+
+    # A shallow clone is deepened only down to its existing boundary
+    git("fetch", source, f"+refs/heads/{branch}:{tracking_ref}", cwd=repo_folder)
+
+    try:
+        git("merge-base", "--is-ancestor", "HEAD", tracking_ref, cwd=repo_folder)
+        git("merge", "--ff-only", tracking_ref, cwd=repo_folder)
+    except GitError:
+        return DIVERGED, True
+    return FAST_FORWARDED, True
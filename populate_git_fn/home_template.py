@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+
+from no_follow import REFUSED, open_folder, open_root, remove_entry
+
+# Files are linked or copied in parallel to hide the EFS latency
+MAX_WORKERS = 32
+
+# Types of the manifest entries
+DIR = "dir"
+FILE = "file"
+LINK = "link"
+
+
+def _digest(path, dir_fd=None):
+    sha = hashlib.sha256()
+    with open(os.open(path, os.O_RDONLY | os.O_NOFOLLOW, dir_fd=dir_fd), "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def build_manifest(template):
+    """Describe every entry of the template folder, parents before children."""
+    entries = []
+    for folder, dirs, files in os.walk(template):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            path = os.path.join(folder, name)
+            st = os.lstat(path)
+            entry = {"path": os.path.relpath(path, template), "mode": st.st_mode}
+            if stat.S_ISLNK(st.st_mode):
+                entry.update(type=LINK, digest=os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entry.update(type=DIR)
+            else:
+                entry.update(
+                    type=FILE,
+                    digest=_digest(path),
+                    readonly=not st.st_mode & stat.S_IWUSR,
+                )
+            entries.append(entry)
+    return entries
+
+
+def install_version(template_root, version, source):
+    """Make the template in the source folder available as version.
+
+    The files are moved to template_root/versions/<version>, their manifest
+    written next to them, and version becomes the current one.
+    """
+    versions = template_root / "versions"
+    versions.mkdir(parents=True, exist_ok=True)
+    target = versions / version
+    if not target.exists():
+        manifest = build_manifest(source)
+        (versions / f"{version}.json").write_text(json.dumps(manifest))
+        source.rename(target)
+    _write_atomic(template_root / "current", version)
+
+
+def current_version(template_root):
+    """Return the current version and its manifest, or (None, None)."""
+    try:
+        version = (template_root / "current").read_text().strip()
+    except FileNotFoundError:
+        return None, None
+    manifest = json.loads((template_root / "versions" / f"{version}.json").read_text())
+    return version, manifest
+
+
+def _write_atomic(path, text):
+    partial = path.with_name(f".{path.name}.partial")
+    partial.write_text(text)
+    os.replace(partial, path)
+
+
+def _create_file(entry, source, partial, dir_fd, uid, gid):
+    # The template files without write permission are shared with every user
+    # home through hardlinks, the others are copied and given to the user
+    if entry["type"] == LINK:
+        os.symlink(entry["digest"], partial, dir_fd=dir_fd)
+        os.chown(partial, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+    elif entry["readonly"]:
+        os.link(source, partial, dst_dir_fd=dir_fd)
+    else:
+        # Owned by the user from the start, no ownership pass afterwards
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+        fd = os.open(partial, flags, 0o600, dir_fd=dir_fd)
+        with open(fd, "wb") as dst, open(source, "rb") as src:
+            os.fchown(fd, uid, gid)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.fchmod(fd, stat.S_IMODE(entry["mode"]))
+
+
+def _apply_file(entry, template, home_fd, uid, gid, applied):
+    """Create the file of entry in home, unless the user has made it their own.
+
+    Returns the outcome and the digest now applied to the path.
+    """
+    path = entry["path"]
+    parts = PurePosixPath(path).parts
+    previous = applied.get(path)
+    try:
+        # The home belongs to the user: nothing is written through a symlink
+        folder = open_folder(home_fd, parts[:-1])
+    except OSError as err:
+        if err.errno not in REFUSED:
+            raise
+        # A folder of the template replaced by the user with a symlink or a file
+        return "kept", previous
+    try:
+        return _apply_in_folder(entry, template, folder, parts[-1], uid, gid, previous)
+    finally:
+        os.close(folder)
+
+
+def _apply_in_folder(entry, template, folder, name, uid, gid, previous):
+    try:
+        st = os.stat(name, dir_fd=folder, follow_symlinks=False)
+    except FileNotFoundError:
+        st = None
+    if previous == entry["digest"] and st is not None:
+        return "unchanged", previous
+    if st is not None:
+        if previous is None:
+            # Created by the user, not by an earlier version of the template
+            return "kept", None
+        if stat.S_ISLNK(st.st_mode):
+            current = os.readlink(name, dir_fd=folder)
+        elif entry["type"] == LINK or not stat.S_ISREG(st.st_mode):
+            current = None
+        else:
+            current = _digest(name, dir_fd=folder)
+        if current != previous:
+            return "kept", previous
+
+    partial = f".{name}.tmpl"
+    remove_entry(partial, folder)
+    source = os.path.join(template, entry["path"])
+    _create_file(entry, source, partial, folder, uid, gid)
+    # Replaces a symlink itself, never its target
+    os.replace(partial, name, src_dir_fd=folder, dst_dir_fd=folder)
+    if entry["type"] == FILE and entry["readonly"]:
+        return "linked", entry["digest"]
+    return "copied", entry["digest"]
+
+
+def apply_template(template, manifest, home, uid, applied, gid=-1):
+    """Materialize the template folder described by manifest into home.
+
+    applied maps the paths written by earlier runs to the digest they were
+    given. Files already at the template digest are skipped, and so are the
+    files the user created or modified: a template update never overwrites
+    their changes. Returns the number of entries by outcome and the new
+    applied map.
+    """
+    stats = {"linked": 0, "copied": 0, "folders": 0, "unchanged": 0, "kept": 0}
+    new_applied = {}
+
+    home_fd = open_root(home)
+    try:
+        for entry in manifest:
+            if entry["type"] != DIR:
+                continue
+            parts = PurePosixPath(entry["path"]).parts
+            try:
+                folder = open_folder(home_fd, parts[:-1])
+            except OSError as err:
+                if err.errno not in REFUSED:
+                    raise
+                continue
+            try:
+                os.mkdir(parts[-1], stat.S_IMODE(entry["mode"]), dir_fd=folder)
+                os.chown(parts[-1], uid, gid, dir_fd=folder, follow_symlinks=False)
+            except FileExistsError:
+                # Already there, or just created by a repository clone running
+                # alongside
+                continue
+            finally:
+                os.close(folder)
+            stats["folders"] += 1
+
+        files = [k for k in manifest if k["type"] != DIR]
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            results = pool.map(
+                lambda k: _apply_file(k, template, home_fd, uid, gid, applied), files
+            )
+            for entry, (outcome, digest) in zip(files, results):
+                stats[outcome] += 1
+                if digest is not None:
+                    new_applied[entry["path"]] = digest
+    finally:
+        os.close(home_fd)
+    return stats, new_applied
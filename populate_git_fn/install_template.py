@@ -0,0 +1,56 @@
+import logging
+import shutil
+
+from efs_layout import HOME_TEMPLATE_ROOT, TRASH_ROOT
+from home_template import install_version
+from s3_archive import extract_archive, s3_client
+from trash import move_to_trash
+
+
+def on_event(event, context):
+    request_type = event["RequestType"]
+    if request_type in ("Create", "Update"):
+        return on_install(event)
+    if request_type == "Delete":
+        return on_delete(event)
+    raise Exception(f"Invalid request type: {request_type}")
+
+
+def on_install(event):
+    """Extract the template archive as a new version and make it the current one."""
+    props = event["ResourceProperties"]
+    version = props["Version"]
+    versions = HOME_TEMPLATE_ROOT / "versions"
+
+    if not (versions / version).exists():
+        partial = versions / f"{version}.partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        partial.mkdir(parents=True)
+        # Read-only for the users: the files stay with root, the links to them
+        # in the user homes included
+        stats = extract_archive(s3_client(), props["ArchiveUri"], partial, uid=0)
+        print(f"Extracted {stats['entries']} entries of template {version}")
+        # The archive holds a single folder, the template itself
+        (source,) = partial.iterdir()
+        install_version(HOME_TEMPLATE_ROOT, version, source)
+        partial.rmdir()
+    else:
+        install_version(HOME_TEMPLATE_ROOT, version, versions / version)
+
+    # The hardlinks of the user homes keep the files of the older versions
+    # alive, their folders are only needed to apply them
+    for previous in versions.iterdir():
+        if previous.name not in (version, f"{version}.json"):
+            move_to_trash(previous, TRASH_ROOT, 0)
+
+    logging.info("**Home template %s installed", version)
+    return {"PhysicalResourceId": "home-template", "Data": {"Version": version}}
+
+
+def on_delete(event):
+    # New users no longer get the template, existing homes are left as they are
+    current = HOME_TEMPLATE_ROOT / "current"
+    if current.exists():
+        current.unlink()
+    move_to_trash(HOME_TEMPLATE_ROOT / "versions", TRASH_ROOT, 0)
+    logging.info("**Home template removed")
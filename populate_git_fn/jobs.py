@@ -0,0 +1,34 @@
+import json
+import os
+
+from efs_layout import JOBS_ROOT
+
+# The work of an asynchronous request is checkpointed on the EFS volume, so
+# that every invocation of is_complete() resumes where the previous one stopped.
+
+
+def _job_path(job_id):
+    return JOBS_ROOT / f"{job_id}.json"
+
+
+def save_job(job_id, job):
+    JOBS_ROOT.mkdir(exist_ok=True)
+    path = _job_path(job_id)
+    partial = path.with_suffix(".partial")
+    partial.write_text(json.dumps(job))
+    # Never leave a truncated checkpoint behind
+    os.replace(partial, path)
+
+
+def load_job(job_id):
+    try:
+        return json.loads(_job_path(job_id).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def delete_job(job_id):
+    try:
+        _job_path(job_id).unlink()
+    except FileNotFoundError:
+        pass
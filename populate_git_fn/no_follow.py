@@ -0,0 +1,57 @@
+import errno
+import os
+
+# Errors of an entry that is a symlink, or not of the expected type, where a
+# folder or a new entry was expected
+REFUSED = {errno.ELOOP, errno.ENOTDIR, errno.EISDIR, errno.EEXIST}
+
+FOLDER_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+
+
+def open_root(path):
+    """Open the folder all the other paths are resolved from."""
+    return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+
+def open_folder(dir_fd, parts, uid=None, gid=-1, mode=0o755, created=None):
+    """Open the folder at parts below dir_fd, without following any symlink.
+
+    The functions run as root in folders owned by the users, where a symlink
+    such as course -> /mnt/efs/<other uid> would have them write into another
+    home. Each component is opened relative to the previous one with
+    O_NOFOLLOW, and raises OSError with an errno in REFUSED when it is a
+    symlink or a file. With uid set, the missing folders are created and given
+    to uid, and appended to the created list if any. Returns a descriptor the
+    caller closes.
+    """
+    fd = os.dup(dir_fd)
+    try:
+        for part in parts:
+            if uid is not None:
+                try:
+                    os.mkdir(part, mode, dir_fd=fd)
+                    os.chown(part, uid, gid, dir_fd=fd, follow_symlinks=False)
+                    if created is not None:
+                        created.append(part)
+                except FileExistsError:
+                    pass
+            child = os.open(part, FOLDER_FLAGS, dir_fd=fd)
+            os.close(fd)
+            fd = child
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def remove_entry(name, dir_fd):
+    """Remove the file or symlink name from dir_fd, if any, to create it anew.
+
+    Writing through an existing entry would follow a symlink, or change every
+    hardlink of the file, such as the ones shared with the home template.
+    Raises IsADirectoryError for a folder.
+    """
+    try:
+        os.unlink(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
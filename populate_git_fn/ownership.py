@@ -0,0 +1,53 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Every ownership change is a metadata round trip to EFS, so the calls are
+# fanned out over a pool of threads to hide the latency.
+MAX_WORKERS = 32
+
+
+def iter_tree(root):
+    """Yield the path of every entry below root, without following symlinks."""
+    folders = [root]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                yield entry.path
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+
+
+def _set_owner(path, uid, gid):
+    st = os.lstat(path)
+    if st.st_uid == uid and (gid == -1 or st.st_gid == gid):
+        return False
+    os.chown(path, uid=uid, gid=gid, follow_symlinks=False)
+    return True
+
+
+def chown_tree(root, uid, gid=-1, max_workers=MAX_WORKERS):
+    """Set the ownership of root and everything below it.
+
+    Entries already owned by uid (and gid, unless -1) are left untouched.
+    Returns a dictionary with the number of entries visited and changed.
+    """
+    stats = {"visited": 0, "changed": 0}
+
+    def collect(done):
+        for future in done:
+            stats["visited"] += 1
+            stats["changed"] += future.result()
+
+    # Bound the number of pending calls so the walk never builds a full file list
+    max_pending = max_workers * 4
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending.add(pool.submit(_set_owner, os.fspath(root), uid, gid))
+        for path in iter_tree(root):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(_set_owner, path, uid, gid))
+        collect(wait(pending).done)
+
+    return stats
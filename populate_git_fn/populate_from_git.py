@@ -1,17 +1,76 @@
+import json
 import logging
 import os
 import shutil
+import tempfile
+import time
 import traceback
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
 
-import boto3
-from git import Repo
+import emf
+from aws_clients import client, retries
 
-smclient = boto3.client("sagemaker")
+from datasets import HARDLINK, link_dataset
+from efs_copy import copy_tree
+from efs_layout import (
+    ARCHIVE_ROOT,
+    DATASETS_ROOT,
+    EFS_ROOT,
+    GIT_CACHE_ROOT,
+    HOME_TEMPLATE_ROOT,
+    SEED_ARCHIVE_STATE_ROOT,
+    TRASH_ROOT,
+    USAGE_ROOT,
+)
+from git_cache import clone_from_mirror, refresh_mirror
+from git_cli import clone, git
+from git_update import fast_forward, open_clone
+from home_template import apply_template, current_version
+from jobs import delete_job, load_job, save_job
+from no_follow import open_folder, open_root
+from ownership import chown_tree
+from s3_archive import extract_archive, parse_s3_uri, s3_client
+from trash import move_to_trash
+
+# Time spent importing the modules from emf on, boto3 excluded as it is only
+# imported by the first client() call. Reported with the first metrics.
+INIT_DURATION = time.monotonic() - emf.IMPORTED_AT
+
+# Number of repositories cloned at the same time for one user
+MAX_PARALLEL_STEPS = 4
+
+# With the asynchronous provider, on_event() only records the work to do and
+# is_complete() carries it out over as many invocations as needed
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "false") == "true"
+# is_complete() does not start new steps in the last STEP_MARGIN seconds of an
+# invocation, and gives up on a step interrupted MAX_ATTEMPTS times by the timeout.
+# A step is retried from scratch: a single clone, archive or template has to
+# complete within one invocation, 15 minutes less STEP_MARGIN
+STEP_MARGIN = 120
+MAX_ATTEMPTS = 3
+
+# When set, repositories are cloned to this folder of the Lambda ephemeral
+# storage, then copied to EFS by parallel writers instead of git writing one
+# file at a time over NFS
+STAGING_ROOT = os.environ.get("STAGING_ROOT")
+
+# What happens to the home folder when the custom resource is deleted, besides
+# "Delete"
+RETAIN = "Retain"
+ARCHIVE = "Archive"
+
+CLONED = "cloned"
+FAILED = "failed"
 
 
 def on_event(event, context):
+    emf.new_invocation()
     request_type = event["RequestType"]
+    # Direct invocations, e.g. by the roster reconciler, have no RequestId and
+    # are always run to completion
+    if ASYNC_MODE and "RequestId" in event:
+        return start_job(event)
     if request_type == "Create":
         return on_create(event)
     if request_type == "Update":
@@ -21,71 +80,604 @@ def on_event(event, context):
     raise Exception(f"Invalid request type: {request_type}")
 
 
-def on_create(event):
-    props = event["ResourceProperties"]
+def clone_options(props, branch=""):
+    """Translate the optional clone properties of the custom resource into
+    keyword arguments for git_cli.clone() plus the list of sparse-checkout paths."""
+    options = {}
 
-    git_repo = props["GitRepository"]
-    user_profile_name = props["StudioUserName"]
-    domain_id = props["DomainID"]
+    if branch:
+        options["branch"] = branch
+        options["single_branch"] = True
 
-    response = smclient.describe_user_profile(
-        DomainId=domain_id, UserProfileName=user_profile_name
-    )
+    # CloudFormation passes every property as a string, 0 means full history
+    depth = int(props.get("GitDepth") or 0)
+    if depth > 0:
+        options["depth"] = depth
+
+    # Partial clone, e.g. "blob:none" or "tree:0"
+    git_filter = props.get("GitFilter", "")
+    if git_filter:
+        options["filter"] = git_filter
+
+    sparse_paths = [
+        k.strip() for k in props.get("GitSparsePaths", "").split(",") if k.strip()
+    ]
+    if sparse_paths:
+        # Populate the working tree only after the sparse-checkout is configured
+        options["no_checkout"] = True
+
+    return options, sparse_paths
 
+
+def user_efs_uid(props):
+    response = client("sagemaker").describe_user_profile(
+        DomainId=props["DomainID"], UserProfileName=props["StudioUserName"]
+    )
     # Extract the user UID for setting files ownership
-    efs_uid = int(response["HomeEfsFileSystemUid"])
-    home_folder = Path(f"/mnt/efs/{efs_uid}")
+    return int(response["HomeEfsFileSystemUid"])
+
+
+def repo_folder_name(git_repo):
+    # Our target folder for git clone needs to be the *actual* target folder, not the parent
+    # under which a new folder will be created, so we'll infer that from the repo name:
+    folder_name = git_repo.rstrip("/").rpartition("/")[2]
+    if folder_name.lower().endswith(".git"):
+        folder_name = folder_name[: -len(".git")]
+    return folder_name
+
+
+def repositories(props):
+    """Return the repositories to seed, as dictionaries with url, ref and folder.
+
+    GitRepositories is a JSON list whose items are either a URL or an object with
+    "url" and the optional "ref" and "folder" (relative to the home folder).
+    When empty, the single GitRepository is used, if any.
+    """
+    specs = json.loads(props.get("GitRepositories") or "[]")
+    if not specs and props.get("GitRepository"):
+        specs = [props["GitRepository"]]
 
+    repos = []
+    for spec in specs:
+        if isinstance(spec, str):
+            spec = {"url": spec}
+        folder = PurePosixPath(spec.get("folder") or repo_folder_name(spec["url"]))
+        # "." or an empty name would be the home folder itself, which a new
+        # clone moves to the trash
+        if folder.is_absolute() or ".." in folder.parts or not folder.parts:
+            raise ValueError(f"Invalid folder for {spec['url']}: {folder}")
+        # The repositories are cloned at the same time, and keyed by folder
+        for other in repos:
+            shared = PurePosixPath(other["folder"])
+            if folder == shared or shared in folder.parents or folder in shared.parents:
+                raise ValueError(
+                    f"Folder {folder} of {spec['url']} overlaps {shared} of {other['url']}"
+                )
+        repos.append(
+            {
+                "url": spec["url"],
+                "ref": spec.get("ref") or props.get("GitBranch", ""),
+                "folder": str(folder),
+            }
+        )
+    return repos
+
+
+def make_user_folders(home_folder, folder, efs_uid):
+    """Create folder and its missing parents below home_folder, owned by the user.
+
+    Raises OSError if any of them is a symlink, or not a folder.
+    """
+    home_fd = open_root(home_folder)
     try:
-        # The root of the EFS contains folders named for each user UID, but these may not be created before
-        # the user has first logged in (could os.listdir("/mnt/efs") to check):
-        print("Creating/checking home folder...")
-        home_folder.mkdir(exist_ok=True)
+        os.close(open_folder(home_fd, folder.relative_to(home_folder).parts, efs_uid))
+    finally:
+        os.close(home_fd)
+
+
+def git_object_bytes(repo_folder):
+    """Size of the objects stored in the clone, i.e. received from the remote."""
+    total = 0
+    for folder, _, files in os.walk(repo_folder / ".git" / "objects"):
+        total += sum(os.lstat(os.path.join(folder, k)).st_size for k in files)
+    return total
+
+
+def create_repo(step, props, home_folder, efs_uid, metrics):
+    spec = step["repo"]
+    git_repo = spec["url"]
+    repo_folder = home_folder / spec["folder"]
+    if home_folder not in repo_folder.parents:
+        # Checked by repositories() already: never move the home to the trash
+        raise ValueError(f"Invalid folder for {git_repo}: {spec['folder']}")
+
+    # Now ready to clone in Git content (or whatever else...)
+    print(f"Cloning repo... {git_repo}")
+
+    # Before anything is moved or written below them: a user symlink among the
+    # parents, e.g. course -> ../<other uid>, would lead into another home
+    make_user_folders(home_folder, repo_folder.parent, efs_uid)
+    # Deleting a large checkout on EFS is as slow as creating it: move it out
+    # of the way and leave the deletion to the scheduled purge
+    with metrics.timer("Trash"):
+        trashed = move_to_trash(repo_folder, TRASH_ROOT, efs_uid)
+    if trashed is not None:
+        print(f"Moved previous {repo_folder} to {trashed}")
+
+    if STAGING_ROOT:
+        os.makedirs(STAGING_ROOT, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=STAGING_ROOT))
+        try:
+            clone_repo(git_repo, staging / "repo", props, spec, metrics)
+            with metrics.timer("Copy"):
+                copied = copy_tree(staging / "repo", repo_folder, uid=efs_uid)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        written = copied["files"] + copied["links"]
+        metrics.put("FilesWritten", written)
+        metrics.put("FilesChowned", written + copied["folders"])
+        print(f"Copied {written} entries, {copied['bytes']} bytes to {repo_folder}")
+        return {"Status": CLONED}
+
+    clone_repo(git_repo, repo_folder, props, spec, metrics)
+    # Set ownership/permissions for all the stuff just created, to give the user write
+    # access:
+    with metrics.timer("Chown"):
+        ownership = chown_tree(repo_folder, uid=efs_uid)
+    metrics.put("FilesWritten", ownership["visited"])
+    metrics.put("FilesChowned", ownership["changed"])
+    print(
+        f"Ownership set on {ownership['changed']} of {ownership['visited']} entries"
+        f" of {repo_folder}"
+    )
+    return {"Status": CLONED}
+
+
+def clone_repo(git_repo, clone_folder, props, spec, metrics):
+    git_options, sparse_paths = clone_options(props, spec["ref"])
+    git_cache_mode = props.get("GitCache", "none")
+
+    if git_cache_mode == "none":
+        with metrics.timer("Clone"):
+            clone(git_repo, clone_folder, **git_options)
+    else:
+        # Only the shared mirror talks to the upstream, the user clone is local
+        with metrics.timer("Mirror"):
+            mirror = refresh_mirror(GIT_CACHE_ROOT, git_repo)
+        with metrics.timer("Clone"):
+            clone_from_mirror(
+                mirror, git_repo, clone_folder, git_cache_mode, **git_options
+            )
+    metrics.put("BytesReceived", git_object_bytes(clone_folder), "Bytes")
+    if sparse_paths:
+        print(f"Sparse checkout of {sparse_paths}")
+        with metrics.timer("Checkout"):
+            git("sparse-checkout", "init", "--cone", cwd=clone_folder)
+            git("sparse-checkout", "set", *sparse_paths, cwd=clone_folder)
+            git("checkout", cwd=clone_folder)
+
+
+def update_repo(step, props, home_folder, efs_uid, metrics):
+    spec = step["repo"]
+    git_repo = spec["url"]
+    repo_folder = home_folder / spec["folder"]
+    # Neither the folder nor its parents may lead out of the home
+    make_user_folders(home_folder, repo_folder.parent, efs_uid)
+
+    if repo_folder.is_symlink() or open_clone(repo_folder, git_repo) is None:
+        # New repository, or the previous clone is gone or replaced by a symlink:
+        # start from scratch
+        print(f"No existing clone of {git_repo} in {repo_folder}")
+        return create_repo(step, props, home_folder, efs_uid, metrics)
+
+    source = "origin"
+    if props.get("GitCache", "none") != "none":
+        with metrics.timer("Mirror"):
+            source = refresh_mirror(GIT_CACHE_ROOT, git_repo).as_uri()
+
+    received = -git_object_bytes(repo_folder)
+    with metrics.timer("Fetch"):
+        status, fetched = fast_forward(repo_folder, branch=spec["ref"], source=source)
+    received += git_object_bytes(repo_folder)
+    metrics.put("BytesReceived", received, "Bytes")
+    print(f"Repository {repo_folder} is {status}")
+    # The fetched objects and refs are left to root even when the branch has
+    # diverged and the working tree is not touched
+    if fetched:
+        with metrics.timer("Chown"):
+            ownership = chown_tree(repo_folder, uid=efs_uid)
+        metrics.put("FilesChowned", ownership["changed"])
+    return {"Status": status}
+
+
+def seed_from_archive(step, props, home_folder, efs_uid, metrics):
+    """Extract the SeedArchive snapshot into the user home folder.
+
+    With skip_unchanged set on the step, nothing is done if the home folder was
+    already seeded from the same archive version.
+    """
+    uri = step["source"]
+    print(f"Seeding from archive... {uri}")
+    state_file = SEED_ARCHIVE_STATE_ROOT / f"{efs_uid}.json"
+
+    bucket, key = parse_s3_uri(uri)
+    etag = s3_client().head_object(Bucket=bucket, Key=key)["ETag"]
+    state = {"uri": uri, "etag": etag}
+    if (
+        step.get("skip_unchanged")
+        and state_file.exists()
+        and json.loads(state_file.read_text()) == state
+    ):
+        return {"Status": "up-to-date"}
+
+    with metrics.timer("Extract"):
+        stats = extract_archive(s3_client(), uri, home_folder, uid=efs_uid)
+    metrics.put("BytesReceived", stats["bytes"], "Bytes")
+    # Every entry is given to the user as it is extracted
+    metrics.put("FilesWritten", stats["entries"])
+    metrics.put("FilesChowned", stats["entries"])
+    print(f"Extracted {stats['entries']} entries, {stats['bytes']} bytes")
+    SEED_ARCHIVE_STATE_ROOT.mkdir(exist_ok=True)
+    state_file.write_text(json.dumps(state))
+    return {"Status": "extracted", "Bytes": stats["bytes"], "Entries": stats["entries"]}
+
+
+def apply_home_template(step, props, home_folder, efs_uid, metrics):
+    """Bring the home folder up to date with the current home template.
+
+    Only the files changed since the version last applied to this home are
+    written, the files modified by the user are left alone.
+    """
+    version, manifest = current_version(HOME_TEMPLATE_ROOT)
+    state_file = HOME_TEMPLATE_ROOT / "users" / f"{efs_uid}.json"
+    state = {"version": None, "applied": {}}
+    if state_file.exists():
+        state = json.loads(state_file.read_text())
+    if state["version"] == version:
+        return {"Status": "up-to-date", "Version": version}
+
+    print(f"Applying home template {version}")
+    template = HOME_TEMPLATE_ROOT / "versions" / version
+    with metrics.timer("Template"):
+        stats, applied = apply_template(
+            template, manifest, home_folder, efs_uid, state["applied"]
+        )
+    print(f"Home template applied: {stats}")
+    metrics.put("FilesWritten", stats["linked"] + stats["copied"])
+    metrics.put("FilesChowned", stats["copied"] + stats["folders"])
+
+    state_file.parent.mkdir(exist_ok=True)
+    state_file.write_text(json.dumps({"version": version, "applied": applied}))
+    return {
+        "Status": "applied",
+        "Version": version,
+        "Linked": stats["linked"],
+        "Copied": stats["copied"],
+        "Kept": stats["kept"],
+    }
+
 
-        # Now ready to clone in Git content (or whatever else...)
-        print(f"Cloning repo... {git_repo}")
+def link_shared_dataset(step, props, home_folder, efs_uid, metrics):
+    """Expose a dataset of the shared cache in the home folder, without copying it."""
+    if "/" in step["dataset"] or step["dataset"].startswith("."):
+        raise ValueError(f"Invalid dataset name: {step['dataset']}")
+    mode = props.get("DatasetLinkMode") or HARDLINK
+    with metrics.timer("Link"):
+        stats = link_dataset(DATASETS_ROOT, step["dataset"], home_folder, efs_uid, mode)
+    if stats is None:
+        # Linked by the next update once the scheduled sync has downloaded it
+        print(f"Dataset {step['dataset']} is not cached yet")
+        return {"Status": "not-cached"}
+    metrics.put("FilesWritten", stats["linked"])
+    metrics.put("FilesChowned", stats["folders"])
+    return {"Status": "linked", "Linked": stats["linked"], "Kept": stats["kept"]}
 
-        # Our target folder for Repo.clone_from() needs to be the *actual* target folder, not the parent
-        # under which a new folder will be created, so we'll infer that from the repo name:
-        repo_folder_name = git_repo.rpartition("/")[2]
-        if repo_folder_name.lower().endswith(".git"):
-            repo_folder = home_folder / repo_folder_name[: -len(".git")]
 
-        shutil.rmtree(repo_folder, ignore_errors=True)
+def remove_home(step, props, home_folder, efs_uid, metrics):
+    """Detach the home folder of a deleted user, in constant time.
 
-        Repo.clone_from(url=git_repo, to_path=repo_folder)
-        # Set ownership/permissions for all the stuff just created, to give the user write
-        # access:
-        os.chown(repo_folder, uid=efs_uid, gid=-1)
-        [os.chown(p, uid=efs_uid, gid=-1) for p in repo_folder.rglob("*")]
+    With the Delete policy the folder is renamed into the trash area, and its
+    content deleted in the background by the purge function. With Archive it
+    is renamed into the archive area, where it stays until restored or removed
+    by hand.
+    """
+    if not home_folder.exists():
+        return {"Status": "absent"}
+    with metrics.timer("Trash"):
+        if step["policy"] == ARCHIVE:
+            target = move_to_trash(home_folder, ARCHIVE_ROOT, efs_uid)
+            print(f"Archived {home_folder} to {target}")
+            return {"Status": "archived", "Path": str(target)}
+        move_to_trash(home_folder, TRASH_ROOT, efs_uid)
+        # A later profile never gets the same uid, its state can go too
+        for state_file in (
+            SEED_ARCHIVE_STATE_ROOT / f"{efs_uid}.json",
+            HOME_TEMPLATE_ROOT / "users" / f"{efs_uid}.json",
+            USAGE_ROOT / f"{efs_uid}.json",
+        ):
+            if state_file.exists():
+                state_file.unlink()
+    print(f"Moved {home_folder} to the trash")
+    return {"Status": "trashed"}
 
-    except Exception as e:
-        # Don't bring the entire CF stack down just because we couldn't copy a repo:
-        traceback.print_exc()
+
+STEP_ACTIONS = {
+    "create_repo": create_repo,
+    "update_repo": update_repo,
+    "seed_archive": seed_from_archive,
+    "home_template": apply_home_template,
+    "link_dataset": link_shared_dataset,
+    "remove_home": remove_home,
+}
+
+
+def plan_steps(request_type, props):
+    """Return the steps setting up the home folder for request_type.
+
+    Each step is a dictionary with the action to run and the key its outcome
+    is reported under in the response data.
+    """
+    if request_type == "Delete":
+        # Products provisioned before the policy existed retain the home
+        policy = props.get("DeletePolicy", RETAIN)
+        if policy == RETAIN:
+            return []
+        return [
+            {"key": "Home", "action": "remove_home", "source": "Home", "policy": policy}
+        ]
+    steps = []
+    # Installed by the HomeTemplate custom resource of the StudioUserLambda stack
+    if (HOME_TEMPLATE_ROOT / "current").exists():
+        steps.append(
+            {"key": "Template", "action": "home_template", "source": "HomeTemplate"}
+        )
+    for name in [k.strip() for k in props.get("Datasets", "").split(",") if k.strip()]:
+        steps.append(
+            {
+                "key": f"datasets/{name}",
+                "action": "link_dataset",
+                "source": f"dataset:{name}",
+                "dataset": name,
+            }
+        )
+    if props.get("SourceType", "git") == "s3":
+        steps.append(
+            {
+                "key": "Archive",
+                "action": "seed_archive",
+                "source": props.get("SeedArchive")
+                or os.environ.get("DEFAULT_SEED_ARCHIVE", ""),
+                "skip_unchanged": request_type == "Update",
+            }
+        )
+        return steps
+    action = "create_repo" if request_type == "Create" else "update_repo"
+    return steps + [
+        {"key": spec["folder"], "action": action, "source": spec["url"], "repo": spec}
+        for spec in repositories(props)
+    ]
+
+
+def count_failures(data):
+    return sum(v == FAILED for k, v in data.items() if k.endswith(".Status"))
+
+
+def check_failures(request_type, data):
+    """Fail the request when a step failed, once all of them have run.
+
+    Delete requests are the exception: failing them would leave the stack,
+    or the rollback of a failed creation, stuck on the custom resource.
+    """
+    if data["Failed"] and request_type != "Delete":
+        failed = sorted(
+            k[: -len(".Status")]
+            for k, v in data.items()
+            if k.endswith(".Status") and v == FAILED
+        )
+        raise Exception(f"Steps failed: {', '.join(failed)}")
+
+
+def run_steps(steps, props, home_folder, efs_uid, data):
+    """Run steps concurrently, recording the outcome and duration of each one,
+    keyed by the step key, in the response data.
+
+    The metrics of each step are logged with the domain and the repository, or
+    archive, it comes from as dimensions.
+    """
+
+    def run(step):
+        metrics = emf.MetricsLogger(Domain=props["DomainID"], Repository=step["source"])
+        retries_before = retries()
+        start = time.monotonic()
+        with metrics.timer("Step"):
+            try:
+                action = STEP_ACTIONS[step["action"]]
+                result = action(step, props, home_folder, efs_uid, metrics)
+            except Exception as e:
+                # The other steps still run, check_failures() fails the request
+                # once they are done
+                traceback.print_exc()
+                result = {"Status": FAILED}
+        result["Seconds"] = round(time.monotonic() - start, 1)
+        metrics.put("Retries", retries() - retries_before)
+        metrics.put("Failures", int(result["Status"] == FAILED))
+        metrics.flush()
+        return result
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_STEPS) as pool:
+        for step, result in zip(steps, pool.map(run, steps)):
+            for name, value in result.items():
+                data[f"{step['key']}.{name}"] = value
+    data["Failed"] = count_failures(data)
+    return data
+
+
+def user_metrics(props):
+    metrics = emf.MetricsLogger(Domain=props["DomainID"])
+    if emf.cold_start():
+        metrics.put("InitDuration", round(INIT_DURATION * 1000, 1), "Milliseconds")
+    return metrics
+
+
+def prepare_user(props, metrics):
+    """Return the EFS uid and home folder of the user, creating the folder if needed."""
+    with metrics.timer("DescribeUserProfile"):
+        efs_uid = user_efs_uid(props)
+    with metrics.timer("HomeFolder"):
+        home_folder = user_home(efs_uid)
+    return efs_uid, home_folder
+
+
+def user_home(efs_uid):
+    home_folder = EFS_ROOT / str(efs_uid)
+    # The root of the EFS contains folders named for each user UID, but these may not be created before
+    # the user has first logged in (could os.listdir("/mnt/efs") to check):
+    print("Creating/checking home folder...")
+    home_folder.mkdir(exist_ok=True)
+    return home_folder
+
+
+def on_create(event):
+    props = event["ResourceProperties"]
+    user_profile_name = props["StudioUserName"]
+    metrics = user_metrics(props)
+
+    with metrics.timer("Setup"):
+        efs_uid, home_folder = prepare_user(props, metrics)
+        steps = plan_steps("Create", props)
+        data = run_steps(steps, props, home_folder, efs_uid, {})
+    metrics.flush()
+    check_failures("Create", data)
 
     print("All done")
 
     logging.info("**SageMaker Studio user '%s' set up successfully", user_profile_name)
     physical_id = f'user_{efs_uid}'
-    return {'PhysicalResourceId': physical_id }
+    return {'PhysicalResourceId': physical_id, 'Data': data}
 
 
 def on_delete(event):
-    physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
-    user_profile_name = props["StudioUserName"]
-    domain_id = props["DomainID"]
-
     logging.info("**Received delete event")
-    logging.info(
-        f"**Deleting user setup is a no-op: user {user_profile_name} on domain {domain_id}"
-    )
+
+    steps = plan_steps("Delete", props)
+    if not steps:
+        logging.info(
+            "**Home folder of user %s on domain %s retained",
+            props["StudioUserName"],
+            props["DomainID"],
+        )
+        return {"PhysicalResourceId": event["PhysicalResourceId"]}
+
+    metrics = user_metrics(props)
+    with metrics.timer("Setup"):
+        efs_uid = deleted_user_uid(event, metrics)
+        data = run_steps(steps, props, EFS_ROOT / str(efs_uid), efs_uid, {})
+    metrics.flush()
+    return {"PhysicalResourceId": event["PhysicalResourceId"], "Data": data}
+
+
+def deleted_user_uid(event, metrics):
+    """Return the EFS uid of the user of a Delete request.
+
+    It is part of the physical id of the resources created by CloudFormation,
+    the others describe the user profile, still there at that point.
+    """
+    prefix, _, uid = event["PhysicalResourceId"].partition("_")
+    if prefix == "user" and uid.isdigit():
+        return int(uid)
+    with metrics.timer("DescribeUserProfile"):
+        return user_efs_uid(event["ResourceProperties"])
 
 
 def on_update(event):
-    physical_id = event["PhysicalResourceId"]
     props = event["ResourceProperties"]
     logging.info("**Received update event")
-    logging.info(
-        "**Updating user setup is a no-op: user {user_profile_name} on domain {domain_id}",
+    metrics = user_metrics(props)
+
+    with metrics.timer("Setup"):
+        efs_uid, home_folder = prepare_user(props, metrics)
+        steps = plan_steps("Update", props)
+        data = run_steps(steps, props, home_folder, efs_uid, {})
+    metrics.flush()
+    check_failures("Update", data)
+    return {"PhysicalResourceId": event["PhysicalResourceId"], "Data": data}
+
+
+def start_job(event):
+    """Record the steps of the request and return at once."""
+    request_type = event["RequestType"]
+    props = event["ResourceProperties"]
+
+    steps = plan_steps(request_type, props)
+    for step in steps:
+        step["attempts"] = 0
+    efs_uid = None
+    if steps:
+        metrics = user_metrics(props)
+        if request_type == "Delete":
+            efs_uid = deleted_user_uid(event, metrics)
+        else:
+            with metrics.timer("DescribeUserProfile"):
+                efs_uid = user_efs_uid(props)
+        metrics.flush()
+    if request_type == "Create":
+        physical_id = f"user_{efs_uid}"
+    else:
+        physical_id = event["PhysicalResourceId"]
+
+    save_job(
+        event["RequestId"],
+        {
+            "uid": efs_uid,
+            "request": request_type,
+            "props": props,
+            "pending": steps,
+            "data": {},
+        },
     )
+    print(f"Queued {len(steps)} steps for {request_type} of {physical_id}")
+    return {"PhysicalResourceId": physical_id}
+
+
+def is_complete(event, context):
+    """Run the pending steps of the request until done or close to the timeout."""
+    emf.new_invocation()
+    job = load_job(event["RequestId"])
+    if job is None:
+        return {"IsComplete": True}
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000
+    deadline -= STEP_MARGIN
+
+    props = job["props"]
+    data = job["data"]
+    if job.get("request") == "Delete":
+        home_folder = EFS_ROOT / str(job["uid"])
+    elif job["pending"]:
+        home_folder = user_home(job["uid"])
+    while job["pending"]:
+        if time.monotonic() > deadline:
+            print(f"{len(job['pending'])} steps left for the next invocation")
+            save_job(event["RequestId"], job)
+            return {"IsComplete": False}
+
+        batch = job["pending"][:MAX_PARALLEL_STEPS]
+        job["pending"] = job["pending"][MAX_PARALLEL_STEPS:]
+        for step in [k for k in batch if k["attempts"] >= MAX_ATTEMPTS]:
+            print(f"Giving up on {step['key']} after {step['attempts']} attempts")
+            data[f"{step['key']}.Status"] = FAILED
+            batch.remove(step)
+
+        # Checkpoint before running: a step cut short by the Lambda timeout is
+        # still pending, and retried, in the next invocation
+        for step in batch:
+            step["attempts"] += 1
+        save_job(event["RequestId"], dict(job, pending=batch + job["pending"]))
+        run_steps(batch, props, home_folder, job["uid"], data)
+        save_job(event["RequestId"], job)
+
+    delete_job(event["RequestId"])
+    data["Failed"] = count_failures(data)
+    check_failures(job.get("request"), data)
+    print("All done")
+    return {"IsComplete": True, "Data": data}
@@ -0,0 +1,19 @@
+import logging
+import time
+
+from efs_layout import TRASH_ROOT
+from trash import purge
+
+# Time kept in reserve to stop the pending deletions before the Lambda timeout
+SAFETY_MARGIN = 30
+
+
+def on_schedule(event, context):
+    deadline = (
+        time.monotonic() + context.get_remaining_time_in_millis() / 1000 - SAFETY_MARGIN
+    )
+    stats = purge(TRASH_ROOT, deadline)
+    logging.info("**Purged %s trashed folders", stats["purged"])
+    if stats["remaining"]:
+        print("Trash not empty yet, the next run will continue")
+    return stats
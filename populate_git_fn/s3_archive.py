@@ -0,0 +1,219 @@
+import io
+import os
+import posixpath
+import shutil
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+from urllib.parse import urlparse
+
+from aws_clients import client
+from no_follow import REFUSED, open_folder, open_root, remove_entry
+
+# Size of each ranged GET, and number of ranges fetched ahead of the extraction
+CHUNK_SIZE = 8 * 1024 * 1024
+PREFETCH = 4
+
+
+def s3_client():
+    # S3_ENDPOINT_URL allows testing against a local S3 stand-in
+    return client("s3", endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None)
+
+
+def parse_s3_uri(uri):
+    parsed = urlparse(uri)
+    if parsed.scheme != "s3" or not parsed.netloc or not parsed.path[1:]:
+        raise ValueError(f"Invalid S3 URI: {uri}")
+    return parsed.netloc, parsed.path[1:]
+
+
+class S3RangeReader(io.RawIOBase):
+    """Read-only, forward-only file object over an S3 object.
+
+    The object is fetched with successive ranged GETs, PREFETCH of them in
+    flight while the previous ones are consumed, so nothing is ever written to
+    local storage. All the ranges are pinned to the ETag of the first request.
+    """
+
+    def __init__(self, client, bucket, key, chunk_size=CHUNK_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.chunk_size = chunk_size
+
+        head = client.head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+
+        self._pool = ThreadPoolExecutor(max_workers=PREFETCH)
+        self._ranges = deque()
+        self._next_start = 0
+        self._buffer = memoryview(b"")
+        self.bytes_read = 0
+        for _ in range(PREFETCH):
+            self._schedule()
+
+    def _fetch(self, start, end):
+        response = self.client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f"bytes={start}-{end}",
+            IfMatch=self.etag,
+        )
+        return response["Body"].read()
+
+    def _schedule(self):
+        if self._next_start >= self.size:
+            return
+        end = min(self._next_start + self.chunk_size, self.size) - 1
+        self._ranges.append(self._pool.submit(self._fetch, self._next_start, end))
+        self._next_start = end + 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            if not self._ranges:
+                return 0
+            self._buffer = memoryview(self._ranges.popleft().result())
+            self._schedule()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        self.bytes_read += n
+        return n
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        super().close()
+
+
+def _is_safe(member):
+    """Reject members that would be written, or would point, outside the target."""
+    name = PurePosixPath(member.name)
+    if name.is_absolute() or ".." in name.parts:
+        return False
+    if member.issym() or member.islnk():
+        if posixpath.isabs(member.linkname):
+            return False
+        # Symlinks are relative to their folder, hardlinks to the archive root
+        base = str(name.parent) if member.issym() else ""
+        link = posixpath.normpath(posixpath.join(base, member.linkname))
+        if link == ".." or link.startswith("../"):
+            return False
+    return member.isfile() or member.isdir() or member.issym() or member.islnk()
+
+
+class _Folders:
+    """Descriptors of the folders entries are extracted to.
+
+    Archives list the entries of a folder together, so the folder of the
+    previous entry is kept open instead of walking its path again.
+    """
+
+    def __init__(self, root_fd, uid, gid):
+        self.root_fd = root_fd
+        self.uid = uid
+        self.gid = gid
+        self._parts = None
+        self._fd = None
+
+    def open(self, parts):
+        if parts != self._parts:
+            # Folders without an entry of their own in the archive are created
+            # and given to uid as well
+            fd = open_folder(self.root_fd, parts, self.uid, self.gid)
+            self.close()
+            self._parts, self._fd = parts, fd
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._parts = self._fd = None
+
+
+def _extract_member(archive, member, folders, uid, gid):
+    # Every path is resolved from the target without following symlinks, the
+    # ones of the archive or the ones already in the folder, and every file is
+    # created anew instead of written through an existing entry
+    parts = PurePosixPath(member.name).parts
+    if member.isdir():
+        fd = folders.open(parts)
+        os.fchown(fd, uid, gid)
+        os.fchmod(fd, member.mode & 0o777)
+        return
+    folder = folders.open(parts[:-1])
+    name = parts[-1]
+    remove_entry(name, folder)
+    if member.isfile():
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+        fd = os.open(name, flags, 0o600, dir_fd=folder)
+        with open(fd, "wb") as dst:
+            os.fchown(fd, uid, gid)
+            shutil.copyfileobj(archive.extractfile(member), dst, 1024 * 1024)
+            dst.flush()
+            os.fchmod(fd, member.mode & 0o777)
+            os.utime(fd, (member.mtime, member.mtime))
+    elif member.issym():
+        os.symlink(member.linkname, name, dir_fd=folder)
+        os.chown(name, uid, gid, dir_fd=folder, follow_symlinks=False)
+    else:
+        link = PurePosixPath(member.linkname).parts
+        source = open_folder(folders.root_fd, link[:-1])
+        try:
+            os.link(
+                link[-1],
+                name,
+                src_dir_fd=source,
+                dst_dir_fd=folder,
+                follow_symlinks=False,
+            )
+        finally:
+            os.close(source)
+
+
+def extract_archive(client, uri, target, uid, gid=-1):
+    """Stream the tar.gz or tar.zst archive at uri into target.
+
+    Every entry is given to uid as soon as it is written, so no separate
+    ownership pass is needed. Entries that would be written through a symlink,
+    including one already in target, are skipped. Returns a dictionary with the number of bytes
+    received and entries written.
+    """
+    bucket, key = parse_s3_uri(uri)
+    raw = S3RangeReader(client, bucket, key)
+    stream = io.BufferedReader(raw, buffer_size=1024 * 1024)
+    if key.endswith((".zst", ".tzst")):
+        import zstandard
+
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        mode = "r|"
+    else:
+        mode = "r|gz"
+
+    stats = {"bytes": 0, "entries": 0, "skipped": 0}
+    folders = _Folders(open_root(target), uid, gid)
+    try:
+        with tarfile.open(fileobj=stream, mode=mode) as archive:
+            for member in archive:
+                if _is_safe(member):
+                    try:
+                        _extract_member(archive, member, folders, uid, gid)
+                        stats["entries"] += 1
+                        continue
+                    except OSError as err:
+                        # Through a symlink, or over a folder
+                        if err.errno not in REFUSED:
+                            raise
+                print(f"Skipping {member.name}")
+                stats["skipped"] += 1
+    finally:
+        folders.close()
+        os.close(folders.root_fd)
+        stream.close()
+        stats["bytes"] = raw.bytes_read
+        raw.close()
+    return stats
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import emf
+from aws_clients import client
+
+from efs_layout import EFS_ROOT, USAGE_ROOT
+from efs_usage import load_usage, scan_homes
+from s3_archive import s3_client
+
+# Time kept in reserve to write the report before the Lambda timeout
+SAFETY_MARGIN = 120
+# Homes scanned together, each batch stops listing folders at the deadline
+BATCH_SIZE = 50
+REPORT_PREFIX = "efs-usage"
+
+
+def profile_names(domain_id):
+    """Map the EFS uid of every user profile of the domain to its name.
+
+    The uids are only returned by DescribeUserProfile: they are kept in
+    USAGE_ROOT/profiles.json, and only the profiles created since the previous
+    run are described.
+    """
+    path = USAGE_ROOT / "profiles.json"
+    try:
+        known = json.loads(path.read_text())
+    except FileNotFoundError:
+        known = {}
+
+    sagemaker = client("sagemaker")
+    names = [
+        profile["UserProfileName"]
+        for page in sagemaker.get_paginator("list_user_profiles").paginate(
+            DomainIdEquals=domain_id
+        )
+        for profile in page["UserProfiles"]
+    ]
+
+    def describe(name):
+        response = sagemaker.describe_user_profile(
+            DomainId=domain_id, UserProfileName=name
+        )
+        # Not set until the profile is created
+        return response.get("HomeEfsFileSystemUid")
+
+    new_names = [k for k in names if k not in known]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        uids = dict(zip(new_names, pool.map(describe, new_names)))
+    # Profiles deleted since are dropped
+    profiles = {k: known.get(k) or uids[k] for k in names if known.get(k) or uids[k]}
+
+    USAGE_ROOT.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f".{path.name}.partial")
+    partial.write_text(json.dumps(profiles))
+    os.replace(partial, path)
+    return {str(uid): name for name, uid in profiles.items()}
+
+
+def home_uids():
+    # The reserved folders all start with a dot
+    return [k.name for k in EFS_ROOT.iterdir() if k.name.isdigit()]
+
+
+def on_schedule(event, context):
+    """Measure the EFS usage of every user home, publish it as metrics and
+    write it as a JSON lines report to the REPORT_BUCKET bucket.
+
+    The homes scanned the longest ago go first. Those not reached, or not
+    walked in full, before the deadline are reported with the usage found by
+    an earlier run, and scanned first by the next one. The walk of a home cut
+    short carries on from where it stopped.
+    """
+    emf.new_invocation()
+    deadline = (
+        time.monotonic() + context.get_remaining_time_in_millis() / 1000 - SAFETY_MARGIN
+    )
+    domain_id = os.environ["DOMAIN_ID"]
+    profiles = profile_names(domain_id)
+
+    usage = {uid: load_usage(USAGE_ROOT, uid) for uid in home_uids()}
+    pending = sorted(usage, key=lambda k: (usage[k] or {}).get("scanned_at", 0))
+    unfinished = 0
+    metrics = emf.MetricsLogger(Domain=domain_id)
+    with metrics.timer("Scan"):
+        while pending and time.monotonic() < deadline:
+            batch, pending = pending[:BATCH_SIZE], pending[BATCH_SIZE:]
+            scanned, stats = scan_homes(EFS_ROOT, USAGE_ROOT, batch, deadline)
+            usage.update(scanned)
+            unfinished += stats["unfinished"]
+            metrics.add("FoldersListed", stats["listed"])
+            metrics.add("FoldersReused", stats["reused"])
+    metrics.put("HomesScanned", len(usage) - len(pending) - unfinished)
+    metrics.put("HomesPending", len(pending) + unfinished)
+
+    lines = []
+    for uid, home in sorted(usage.items()):
+        if home is None or "scanned_at" not in home:
+            # Never scanned in full yet
+            continue
+        profile = profiles.get(uid)
+        lines.append(
+            {
+                "uid": int(uid),
+                "profile": profile,
+                "bytes": home["bytes"],
+                "shared_bytes": home["shared_bytes"],
+                "inodes": home["inodes"],
+                "scanned_at": home["scanned_at"],
+            }
+        )
+        if profile is None:
+            # Home of a deleted profile
+            metrics.add("OrphanBytes", home["bytes"], "Bytes")
+            continue
+        user = emf.MetricsLogger(Domain=domain_id, UserProfile=profile)
+        user.put("HomeBytes", home["bytes"], "Bytes")
+        user.put("SharedBytes", home["shared_bytes"], "Bytes")
+        user.put("HomeInodes", home["inodes"])
+        user.flush()
+    metrics.flush()
+
+    report = "".join(json.dumps(k) + "\n" for k in lines)
+    bucket = os.environ.get("REPORT_BUCKET")
+    if bucket:
+        stamp = time.strftime("%Y-%m-%dT%H-%M-%SZ", time.gmtime())
+        for key in (f"{stamp}.jsonl", "latest.jsonl"):
+            s3_client().put_object(
+                Bucket=bucket,
+                Key=f"{REPORT_PREFIX}/{domain_id}/{key}",
+                Body=report.encode(),
+                ContentType="application/x-ndjson",
+            )
+    pending_homes = len(pending) + unfinished
+    logging.info("**Usage of %s homes reported, %s pending", len(lines), pending_homes)
+    return {"Homes": len(lines), "Pending": pending_homes}
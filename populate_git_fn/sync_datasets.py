@@ -0,0 +1,27 @@
+import json
+import logging
+import os
+import time
+
+from datasets import sync_dataset
+from efs_layout import DATASETS_ROOT
+from s3_archive import s3_client
+
+# Time kept in reserve to finish the downloads in flight before the Lambda timeout
+SAFETY_MARGIN = 120
+
+
+def on_schedule(event, context):
+    """Refresh the cache of every dataset declared in the DATASETS variable,
+    a JSON object mapping dataset names to s3:// prefixes."""
+    deadline = (
+        time.monotonic() + context.get_remaining_time_in_millis() / 1000 - SAFETY_MARGIN
+    )
+    datasets = json.loads(os.environ.get("DATASETS", "{}"))
+    results = {}
+    for name, uri in sorted(datasets.items()):
+        results[name] = sync_dataset(s3_client(), DATASETS_ROOT, name, uri, deadline)
+        logging.info("**Dataset %s: %s", name, results[name])
+        if not results[name]["complete"]:
+            print(f"Dataset {name} not complete yet, the next run will continue")
+    return results
@@ -0,0 +1,108 @@
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 32
+# Number of paths removed by a single task of the pool
+BATCH_SIZE = 500
+
+
+def move_to_trash(path, trash_root, uid):
+    """Move path into the trash area of uid and return its new location.
+
+    A rename on the same file system is atomic and takes constant time, so the
+    caller can continue immediately and leave the deletion to purge().
+    """
+    if not os.path.lexists(path):
+        return None
+    target = trash_root / str(uid) / f"{path.name}.{time.time_ns()}"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    path.rename(target)
+    return target
+
+
+def _remove_all(remove, paths):
+    for path in paths:
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _in_batches(paths):
+    for i in range(0, len(paths), BATCH_SIZE):
+        yield paths[i : i + BATCH_SIZE]
+
+
+def purge_tree(root, deadline, pool):
+    """Delete root and everything below it, unless deadline is reached first.
+
+    Files are unlinked in parallel batches while the tree is walked, folders are
+    removed afterwards one depth level at a time, deepest first. Everything left
+    behind after the deadline is picked up by the next call.
+    Returns True once root is gone.
+    """
+    folders_by_depth = defaultdict(list)
+    futures = []
+    batch = []
+    to_visit = [(os.fspath(root), 0)]
+    complete = True
+
+    while to_visit:
+        if time.monotonic() > deadline:
+            complete = False
+            break
+        folder, depth = to_visit.pop()
+        folders_by_depth[depth].append(folder)
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    to_visit.append((entry.path, depth + 1))
+                    continue
+                batch.append(entry.path)
+                if len(batch) >= BATCH_SIZE:
+                    futures.append(pool.submit(_remove_all, os.unlink, batch))
+                    batch = []
+    if batch:
+        futures.append(pool.submit(_remove_all, os.unlink, batch))
+    for future in futures:
+        future.result()
+    if not complete:
+        return False
+
+    for depth in sorted(folders_by_depth, reverse=True):
+        if time.monotonic() > deadline:
+            return False
+        futures = [
+            pool.submit(_remove_all, os.rmdir, k)
+            for k in _in_batches(folders_by_depth[depth])
+        ]
+        for future in futures:
+            future.result()
+    return True
+
+
+def purge(trash_root, deadline, max_workers=MAX_WORKERS):
+    """Empty trash_root, stopping at deadline (a time.monotonic() value).
+
+    Returns a dictionary with the number of trashed folders purged and whether
+    anything is left for the next run.
+    """
+    stats = {"purged": 0, "remaining": False}
+    if not trash_root.exists():
+        return stats
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for uid_folder in trash_root.iterdir():
+            for trashed in uid_folder.iterdir():
+                if trashed.is_dir() and not trashed.is_symlink():
+                    done = purge_tree(trashed, deadline, pool)
+                else:
+                    trashed.unlink()
+                    done = True
+                if not done:
+                    stats["remaining"] = True
+                    return stats
+                stats["purged"] += 1
+    return stats
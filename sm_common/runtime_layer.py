@@ -0,0 +1,19 @@
+from aws_cdk import aws_lambda as lambda_
+from aws_cdk import core as cdk
+
+
+class AwsRuntimeLayer(lambda_.LayerVersion):
+    """Lambda layer with the aws_clients and emf modules shared by the handlers."""
+
+    def __init__(self, scope: cdk.Construct, construct_id: str, **kwargs) -> None:
+        super().__init__(
+            scope,
+            construct_id,
+            code=lambda_.Code.from_asset("aws_runtime_layer"),
+            compatible_runtimes=[
+                lambda_.Runtime.PYTHON_3_7,
+                lambda_.Runtime.PYTHON_3_8,
+            ],
+            description="Shared boto3 clients with rate limiting and EMF metrics",
+            **kwargs,
+        )
@@ -0,0 +1,78 @@
+from aws_cdk import aws_ssm as ssm
+from aws_cdk import core as cdk
+
+# Where the values are written as SSM parameters, with the "ssm" lookup
+PARAMETER_ROOT = "/sagemaker-studio"
+LOOKUPS = ("exports", "ssm")
+
+
+class SharedValues:
+    """Values a stack publishes for the others, such as the domain id.
+
+    They are always exported, named with export_prefix. With the "exports"
+    lookup the other stacks import them, which keeps the publishing stack
+    from updating them and orders the deployments. With "ssm" they are also
+    written as SSM parameters, and the other stacks read them when deployed,
+    through a parameter of the AWS::SSM::Parameter::Value<String> type: none
+    is bound to the publishing stack, and they deploy independently.
+    """
+
+    def __init__(self, export_prefix: str = "", lookup: str = "exports"):
+        if lookup not in LOOKUPS:
+            raise ValueError(f"Invalid lookup {lookup}, expected one of {LOOKUPS}")
+        self.export_prefix = export_prefix
+        self.lookup = lookup
+        # SSM parameters already read, by stack and name
+        self._resolved = {}
+
+    def parameter_name(self, name: str) -> str:
+        return f"{PARAMETER_ROOT}/{self.export_prefix}{name}"
+
+    def parameter_arn(self, scope: cdk.Construct) -> str:
+        """Return the ARN pattern of all the parameters of the values."""
+        stack = cdk.Stack.of(scope)
+        return stack.format_arn(
+            service="ssm",
+            resource="parameter",
+            resource_name=f"{PARAMETER_ROOT.lstrip('/')}/{self.export_prefix}*",
+        )
+
+    def publish(
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        name: str,
+        value: str,
+        description: str,
+    ):
+        cdk.CfnOutput(
+            scope,
+            construct_id,
+            value=value,
+            description=description,
+            export_name=f"{self.export_prefix}{name}",
+        )
+        if self.lookup == "ssm":
+            ssm.StringParameter(
+                scope,
+                f"{construct_id}Parameter",
+                parameter_name=self.parameter_name(name),
+                string_value=value,
+                description=description,
+            )
+
+    def resolve(self, scope: cdk.Construct, name: str) -> str:
+        """Return the value of name, for the stack of scope.
+
+        Each SSM parameter is read once per stack, and its value shared by all
+        the constructs of the stack.
+        """
+        if self.lookup == "exports":
+            return cdk.Fn.import_value(f"{self.export_prefix}{name}")
+        stack = cdk.Stack.of(scope)
+        key = (stack.node.path, name)
+        if key not in self._resolved:
+            self._resolved[key] = ssm.StringParameter.value_for_string_parameter(
+                stack, self.parameter_name(name)
+            )
+        return self._resolved[key]
@@ -3,11 +3,21 @@ from aws_cdk import aws_iam as iam
 from aws_cdk import aws_lambda as lambda_
 from aws_cdk import aws_sagemaker as sagemaker
 from aws_cdk import core as cdk
+from sm_common.runtime_layer import AwsRuntimeLayer
+from sm_common.shared_values import SharedValues
 
 
 class SMSDomainStack(cdk.Stack):
     def __init__(
-        self, scope: cdk.Construct, construct_id: str, vpc: ec2.Vpc = None, **kwargs
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        vpc: ec2.Vpc = None,
+        project_role_arns: list = None,
+        export_prefix: str = "",
+        lookup: str = "exports",
+        service_catalog_roles: bool = True,
+        **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
@@ -83,13 +93,17 @@ class SMSDomainStack(cdk.Stack):
         studio_domain.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
         domain_id = studio_domain.ref
 
-        #### Enable Projects for all studio users
+        #### Enable Projects for all studio users, and the execution roles of the
+        # teams passed in project_role_arns
+        project_roles = [role.role_arn] + list(project_role_arns or [])
         lambda_policy_sc = iam.PolicyStatement(
             effect=iam.Effect.ALLOW,
             actions=[
                 "servicecatalog:AcceptPortfolioShare",
                 "servicecatalog:ListAcceptedPortfolioShares",
                 "servicecatalog:AssociatePrincipalWithPortfolio",
+                "servicecatalog:DisassociatePrincipalFromPortfolio",
+                "servicecatalog:ListPrincipalsForPortfolio",
             ],
             resources=["*"],
         )
@@ -98,7 +112,7 @@ class SMSDomainStack(cdk.Stack):
             actions=[
                 "iam:GetRole",
             ],
-            resources=[role.role_arn],
+            resources=project_roles,
         )
         lambda_policy_sm = iam.PolicyStatement(
             effect=iam.Effect.ALLOW,
@@ -109,17 +123,16 @@ class SMSDomainStack(cdk.Stack):
             resources=["*"],
         )
 
-        # read the code of the python function to pass it inline to create the lambda fn
-        with open("enable_projects_fn/enable_projects.py", encoding="utf8") as fp:
-            handler_code = fp.read()
-
+        # Invoked directly by the custom resource, which can't be moved to a
+        # provider: CloudFormation does not allow changing its service token
         lambda_fn = lambda_.Function(
             self,
             "LambdaEnableSagemakerProjects",
-            code=lambda_.Code.from_inline(handler_code),
-            handler="index.lambda_handler",
+            code=lambda_.Code.from_asset("enable_projects_fn"),
+            handler="enable_projects.on_event",
             runtime=lambda_.Runtime.PYTHON_3_8,
-            timeout=cdk.Duration.seconds(5),
+            timeout=cdk.Duration.minutes(2),
+            layers=[AwsRuntimeLayer(self, "AwsRuntimeLayer")],
             initial_policy=[
                 lambda_policy_iam,
                 lambda_policy_sc,
@@ -130,16 +143,17 @@ class SMSDomainStack(cdk.Stack):
             self,
             "CREnableSagemakerProjects",
             service_token=lambda_fn.function_arn,
-            properties={"ExecutionRole": role.role_arn},
+            properties={"ExecutionRoles": project_roles},
         )
 
         ### Define Stack outputs and corresponding exports
-        cdk.CfnOutput(
+        shared_values = SharedValues(export_prefix, lookup)
+        shared_values.publish(
             self,
             "DomainID",
+            "StudioDomainId",
             value=domain_id,
             description="SageMaker Studio Domain ID",
-            export_name="StudioDomainId",
         )
         cdk.CfnOutput(
             self,
@@ -147,78 +161,81 @@ class SMSDomainStack(cdk.Stack):
             value=studio_domain.attr_url,
             description="SageMaker Studio Domain URL",
         )
-        cdk.CfnOutput(
+        shared_values.publish(
             self,
             "EfsFileSystemID",
+            "StudioDomainEfsId",
             value=studio_domain.attr_home_efs_file_system_id,
             description="SageMaker Studio EFS fileSystem ID",
-            export_name="StudioDomainEfsId",
         )
-        cdk.CfnOutput(
+        shared_values.publish(
             self,
             "SageMakerStudioUserRole",
+            "SageMakerStudioUserRole",
             value=role.role_arn,
             description="SageMaker Studio Role ARN",
-            export_name="SageMakerStudioUserRole",
         )
 
         self.vpc = vpc
         self.domain = studio_domain
         self.user_role = role
 
-        SMSCPL_policy = iam.ManagedPolicy(
-            self,
-            "AmazonSageMakerAdmin-ServiceCatalogProductsServiceRolePolicy",
-            managed_policy_name="AmazonSageMakerAdmin-ServiceCatalogProductsServiceRolePolicy",
-            document=iam.PolicyDocument.from_json(
-                AmazonSageMakerAdmin_ServiceCatalogProductsServiceRolePolicy
-            ),
-        )
+        # The roles SageMaker Projects launches its products with, looked up by
+        # name: a single stack per account can create them
+        if service_catalog_roles:
+            SMSCPL_policy = iam.ManagedPolicy(
+                self,
+                "AmazonSageMakerAdmin-ServiceCatalogProductsServiceRolePolicy",
+                managed_policy_name="AmazonSageMakerAdmin-ServiceCatalogProductsServiceRolePolicy",
+                document=iam.PolicyDocument.from_json(
+                    AmazonSageMakerAdmin_ServiceCatalogProductsServiceRolePolicy
+                ),
+            )
 
-        SMSCPL_role = iam.Role(
-            self,
-            "AmazonSageMakerServiceCatalogProductsLaunchRole",
-            role_name="AmazonSageMakerServiceCatalogProductsLaunchRole",
-            path="/service-role/",
-            managed_policies=[SMSCPL_policy],
-            assumed_by=iam.ServicePrincipal("servicecatalog.amazonaws.com"),
-            description="SageMaker role created from the SageMaker AWS Management Console. This role has the permissions required to launch the Amazon SageMaker portfolio of products from AWS ServiceCatalog.",
-        )
+            SMSCPL_role = iam.Role(
+                self,
+                "AmazonSageMakerServiceCatalogProductsLaunchRole",
+                role_name="AmazonSageMakerServiceCatalogProductsLaunchRole",
+                path="/service-role/",
+                managed_policies=[SMSCPL_policy],
+                assumed_by=iam.ServicePrincipal("servicecatalog.amazonaws.com"),
+                description="SageMaker role created from the SageMaker AWS Management Console. This role has the permissions required to launch the Amazon SageMaker portfolio of products from AWS ServiceCatalog.",
+            )
 
-        SMSCPU_policy = iam.ManagedPolicy(
-            self,
-            "AmazonSageMakerServiceCatalogProductsUseRolePolicy",
-            managed_policy_name="AmazonSageMakerServiceCatalogProductsUseRolePolicy",
-            document=iam.PolicyDocument.from_json(
-                AmazonSageMakerServiceCatalogProductsUseRolePolicy
-            ),
-        )
+            SMSCPU_policy = iam.ManagedPolicy(
+                self,
+                "AmazonSageMakerServiceCatalogProductsUseRolePolicy",
+                managed_policy_name="AmazonSageMakerServiceCatalogProductsUseRolePolicy",
+                document=iam.PolicyDocument.from_json(
+                    AmazonSageMakerServiceCatalogProductsUseRolePolicy
+                ),
+            )
 
-        SMSCPU_role = iam.Role(
-            self,
-            "AmazonSageMakerServiceCatalogProductsUseRole",
-            role_name="AmazonSageMakerServiceCatalogProductsUseRole",
-            path="/service-role/",
-            managed_policies=[SMSCPU_policy],
-            assumed_by=iam.CompositePrincipal(
-                *[
-                    iam.ServicePrincipal(k)
-                    for k in [
-                        "cloudformation.amazonaws.com",
-                        "apigateway.amazonaws.com",
-                        "lambda.amazonaws.com",
-                        "codebuild.amazonaws.com",
-                        "sagemaker.amazonaws.com",
-                        "glue.amazonaws.com",
-                        "events.amazonaws.com",
-                        "states.amazonaws.com",
-                        "codepipeline.amazonaws.com",
-                        "firehose.amazonaws.com",
+            SMSCPU_role = iam.Role(
+                self,
+                "AmazonSageMakerServiceCatalogProductsUseRole",
+                role_name="AmazonSageMakerServiceCatalogProductsUseRole",
+                path="/service-role/",
+                managed_policies=[SMSCPU_policy],
+                assumed_by=iam.CompositePrincipal(
+                    *[
+                        iam.ServicePrincipal(k)
+                        for k in [
+                            "cloudformation.amazonaws.com",
+                            "apigateway.amazonaws.com",
+                            "lambda.amazonaws.com",
+                            "codebuild.amazonaws.com",
+                            "sagemaker.amazonaws.com",
+                            "glue.amazonaws.com",
+                            "events.amazonaws.com",
+                            "states.amazonaws.com",
+                            "codepipeline.amazonaws.com",
+                            "firehose.amazonaws.com",
+                        ]
                     ]
-                ]
-            ),
-            description="SageMaker role created from the SageMaker AWS Management Console. This role has the permissions required to use the Amazon SageMaker portfolio of products from AWS ServiceCatalog.",
-        )
+                ),
+                description="SageMaker role created from the SageMaker AWS Management Console. This role has the permissions required to use the Amazon SageMaker portfolio of products from AWS ServiceCatalog.",
+            )
 
 
 AmazonSageMakerAdmin_ServiceCatalogProductsServiceRolePolicy = {
@@ -720,4 +737,4 @@ AmazonSageMakerServiceCatalogProductsUseRolePolicy = {
         },
         {"Action": ["states:ListStateMachines"], "Resource": "*", "Effect": "Allow"},
     ],
-}
\ No newline at end of file
+}
@@ -1,14 +1,53 @@
 from aws_cdk import aws_ec2 as ec2
 from aws_cdk import core as cdk
 
+# Interface endpoints that can be requested by name, each gets its own
+# security group, open to the VPC on HTTPS
+INTERFACE_ENDPOINTS = {
+    "sagemaker_api": ec2.InterfaceVpcEndpointAwsService.SAGEMAKER_API,
+    "sagemaker_runtime": ec2.InterfaceVpcEndpointAwsService.SAGEMAKER_RUNTIME,
+    "sts": ec2.InterfaceVpcEndpointAwsService.STS,
+    "logs": ec2.InterfaceVpcEndpointAwsService.CLOUDWATCH_LOGS,
+    "ecr": ec2.InterfaceVpcEndpointAwsService.ECR,
+    "ecr_docker": ec2.InterfaceVpcEndpointAwsService.ECR_DOCKER,
+    "servicecatalog": ec2.InterfaceVpcEndpointAwsService.SERVICE_CATALOG,
+    # Lets the setup function clone from CodeCommit without a NAT
+    "codecommit_git": ec2.InterfaceVpcEndpointAwsService.CODECOMMIT_GIT,
+}
+# The S3 gateway endpoint, free, and the interface endpoints for the services
+# used from the VPC
+DEFAULT_ENDPOINTS = ["s3"] + [k for k in INTERFACE_ENDPOINTS if k != "codecommit_git"]
+# Called by the Lambda functions in the private subnet, which have no other way
+# out without a NAT
+REQUIRED_WITHOUT_NAT = {"s3", "sagemaker_api"}
+
 
 class VpcStack(cdk.Stack):
-    def __init__(self, scope: cdk.Construct, id: str, **kwargs) -> None:
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        id: str,
+        endpoints: list = None,
+        nat_gateways: int = 1,
+        **kwargs,
+    ) -> None:
         super().__init__(scope, id, **kwargs)
 
+        endpoints = list(endpoints or [])
+        unknown = set(endpoints) - set(INTERFACE_ENDPOINTS) - {"s3"}
+        if unknown:
+            raise ValueError(f"Unknown VPC endpoints: {sorted(unknown)}")
+        if not nat_gateways and not REQUIRED_WITHOUT_NAT.issubset(endpoints):
+            raise ValueError(
+                f"Without a NAT gateway, the endpoints {sorted(REQUIRED_WITHOUT_NAT)}"
+                " are required"
+            )
+
         # Define a custom VPC for to host the Studio Domain
         # The private subnet and the NAT are only necessary when using
         # lambda fn that need access to the internet in the same VPC.
+        # Without a NAT, the private subnet is isolated and the functions only
+        # reach the services with an endpoint.
         self.vpc = ec2.Vpc(
             self,
             "VPC-SageMaker",
@@ -19,29 +58,39 @@ class VpcStack(cdk.Stack):
                     subnet_type=ec2.SubnetType.PUBLIC, name="Public", cidr_mask=24
                 ),
                 ec2.SubnetConfiguration(
-                    subnet_type=ec2.SubnetType.PRIVATE, name="Private", cidr_mask=24
+                    subnet_type=(
+                        ec2.SubnetType.PRIVATE
+                        if nat_gateways
+                        else ec2.SubnetType.ISOLATED
+                    ),
+                    name="Private",
+                    cidr_mask=24,
                 ),
             ],
             nat_gateway_provider=ec2.NatProvider.gateway(),
-            nat_gateways=1,
+            nat_gateways=nat_gateways,
         )
+        if not nat_gateways and "codecommit_git" not in endpoints:
+            cdk.Annotations.of(self).add_warning(
+                "Without a NAT gateway, home folders can only be seeded from S3"
+            )
 
         ## Create VPC endpoints for all the relevant services
-        #
-        # SageMakerRuntimeEndpoint = self.vpc.add_interface_endpoint(
-        #     "SageMakerRuntimeEndpoint",
-        #     service=ec2.InterfaceVpcEndpointAwsService.SAGEMAKER_RUNTIME,
-        # )
-        # SageMakerRuntimeEndpoint.connections.allow_default_port_from_any_ipv4()
-        # self.vpc.add_interface_endpoint(
-        #     "SageMakerApiEndpoint",
-        #     service=ec2.InterfaceVpcEndpointAwsService.SAGEMAKER_API,
-        # )
-        # self.vpc.add_interface_endpoint(
-        #     "CloudWatchLogsEndpoint",
-        #     service=ec2.InterfaceVpcEndpointAwsService.CLOUDWATCH_LOGS,
-        # )
-        # self.vpc.add_gateway_endpoint(
-        #     "S3Endpoint", service=ec2.GatewayVpcEndpointAwsService("s3")
-        # )
+        # Traffic to S3, the seed archives and datasets above all, goes through
+        # the gateway endpoint instead of the NAT, without data processing charge
+        self.endpoints = {}
+        if "s3" in endpoints:
+            self.endpoints["s3"] = self.vpc.add_gateway_endpoint(
+                "S3Endpoint", service=ec2.GatewayVpcEndpointAwsService.S3
+            )
+        for name in endpoints:
+            if name == "s3":
+                continue
+            # In the private subnet, with a security group of its own. The private
+            # DNS name resolves to it from the whole VPC
+            self.endpoints[name] = self.vpc.add_interface_endpoint(
+                f"{name.title().replace('_', '')}Endpoint",
+                service=INTERFACE_ENDPOINTS[name],
+                private_dns_enabled=True,
+            )
         cdk.CfnOutput(self, "VPC ID", value=self.vpc.vpc_id)
@@ -0,0 +1,391 @@
+"""Reconcile the user profiles of a SageMaker Studio domain with a roster file.
+
+    python -m sm_roster.reconciler roster.yaml [--dry-run] [--concurrency 16] [--rate 5]
+
+The roster lists the users with their tier and the repositories to seed in
+their home folder:
+
+    tiers:
+      standard:
+        instance_type: ml.t3.medium
+      gpu:
+        instance_type: ml.g4dn.xlarge
+        execution_role: arn:aws:iam::123456789012:role/GpuStudioRole
+    users:
+      - name: alice
+        tier: standard
+        repositories:
+          - https://github.com/acere/SagemakerStudioCDK.git
+          - url: https://example.com/course.git
+            ref: main
+            folder: course
+
+Profiles missing from the domain are created and seeded, the ones created by
+this roster are updated to their tier and their repositories fast-forwarded,
+and the ones no longer listed are deleted. Profiles created any other way,
+e.g. through the Service Catalog product, are never touched: listed users who
+already have such a profile are reported as skipped.
+"""
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import boto3
+from botocore.config import Config
+
+# Tag marking the profiles owned by a roster, its value is the roster name
+ROSTER_TAG = "studio-roster"
+# Where the stacks deployed with the "ssm" lookup publish their values, see
+# sm_common/shared_values.py
+PARAMETER_ROOT = "/sagemaker-studio"
+
+
+class RateLimiter:
+    """Token bucket shared by all the workers, allowing rate calls per second."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def load_roster(path: str) -> dict:
+    text = Path(path).read_text()
+    if path.endswith(".json"):
+        return json.loads(text)
+    import yaml
+
+    return yaml.safe_load(text)
+
+
+def contains(current, desired) -> bool:
+    """True if every value of desired is set the same way in current."""
+    if isinstance(desired, dict):
+        return isinstance(current, dict) and all(
+            contains(current.get(k), v) for k, v in desired.items()
+        )
+    return current == desired
+
+
+def read_exports(cfn_client, names: list) -> dict:
+    exports = {}
+    for page in cfn_client.get_paginator("list_exports").paginate():
+        for export in page["Exports"]:
+            if export["Name"] in names:
+                exports[export["Name"]] = export["Value"]
+    return exports
+
+
+def read_parameters(ssm_client, names: list) -> dict:
+    response = ssm_client.get_parameters(Names=names)
+    return {k["Name"]: k["Value"] for k in response["Parameters"]}
+
+
+class Reconciler:
+    def __init__(
+        self,
+        roster: dict,
+        roster_name: str,
+        domain_id: str,
+        default_role: str,
+        function_name: str,
+        rate: float,
+        dry_run: bool = False,
+        session=None,
+    ):
+        session = session or boto3.Session()
+        self.sm = session.client("sagemaker")
+        # The setup function runs for up to 5 minutes: wait for it, and never
+        # retry an invocation that may still be running
+        self.lambda_ = session.client(
+            "lambda", config=Config(read_timeout=900, retries={"max_attempts": 0})
+        )
+        self.roster = roster
+        self.roster_name = roster_name
+        self.domain_id = domain_id
+        self.default_role = default_role
+        self.function_name = function_name
+        self.limiter = RateLimiter(rate, burst=int(rate) or 1)
+        self.dry_run = dry_run
+
+    def call(self, fn, **kwargs):
+        self.limiter.acquire()
+        return fn(**kwargs)
+
+    def existing_profiles(self) -> set:
+        names = set()
+        paginator = self.sm.get_paginator("list_user_profiles")
+        for page in paginator.paginate(DomainIdEquals=self.domain_id):
+            self.limiter.acquire()
+            names.update(
+                k["UserProfileName"]
+                for k in page["UserProfiles"]
+                if k["Status"] not in ("Deleting", "Delete_Failed")
+            )
+        return names
+
+    def user_settings(self, user: dict) -> dict:
+        tier = self.roster.get("tiers", {}).get(user.get("tier", "default"), {})
+        settings = {}
+        role = tier.get("execution_role", self.default_role)
+        if role:
+            settings["ExecutionRole"] = role
+        if "instance_type" in tier:
+            settings["KernelGatewayAppSettings"] = {
+                "DefaultResourceSpec": {"InstanceType": tier["instance_type"]}
+            }
+        return settings
+
+    def wait_for_status(self, name: str, statuses: tuple, timeout: int = 600):
+        delay = 2
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                status = self.call(
+                    self.sm.describe_user_profile,
+                    DomainId=self.domain_id,
+                    UserProfileName=name,
+                )["Status"]
+            except self.sm.exceptions.ResourceNotFound:
+                status = "Deleted"
+            if status in statuses:
+                return status
+            if status.endswith("Failed"):
+                raise RuntimeError(f"User profile {name} is {status}")
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+        raise TimeoutError(f"User profile {name} did not reach {statuses}")
+
+    def seed(self, user: dict, request_type: str) -> dict:
+        """Run the home folder setup function as CloudFormation would."""
+        repositories = user.get("repositories", [])
+        if not repositories and request_type != "Delete":
+            return {}
+        event = {
+            "RequestType": request_type,
+            "PhysicalResourceId": f"roster_{user['name']}",
+            "ResourceProperties": {
+                "StudioUserName": user["name"],
+                "DomainID": self.domain_id,
+                "GitRepository": "",
+                "GitRepositories": json.dumps(repositories),
+            },
+        }
+        response = self.call(
+            self.lambda_.invoke,
+            FunctionName=self.function_name,
+            Payload=json.dumps(event).encode("utf8"),
+        )
+        payload = json.loads(response["Payload"].read() or "{}")
+        if "FunctionError" in response:
+            raise RuntimeError(f"Setup of {user['name']} failed: {payload}")
+        return payload.get("Data", {})
+
+    def create(self, user: dict):
+        name = user["name"]
+        self.call(
+            self.sm.create_user_profile,
+            DomainId=self.domain_id,
+            UserProfileName=name,
+            UserSettings=self.user_settings(user),
+            Tags=[{"Key": ROSTER_TAG, "Value": self.roster_name}],
+        )
+        self.wait_for_status(name, ("InService",))
+        return self.seed(user, "Create")
+
+    def update(self, user: dict):
+        name = user["name"]
+        current = self.call(
+            self.sm.describe_user_profile, DomainId=self.domain_id, UserProfileName=name
+        )
+        settings = self.user_settings(user)
+        if not contains(current.get("UserSettings", {}), settings):
+            self.call(
+                self.sm.update_user_profile,
+                DomainId=self.domain_id,
+                UserProfileName=name,
+                UserSettings=settings,
+            )
+            self.wait_for_status(name, ("InService",))
+        return self.seed(user, "Update")
+
+    def owned_by_roster(self, name: str) -> bool:
+        arn = self.call(
+            self.sm.describe_user_profile, DomainId=self.domain_id, UserProfileName=name
+        )["UserProfileArn"]
+        tags = self.call(self.sm.list_tags, ResourceArn=arn)["Tags"]
+        return {"Key": ROSTER_TAG, "Value": self.roster_name} in tags
+
+    def delete(self, name: str):
+        # The apps of the user have to be gone before the profile can be deleted
+        apps = self.call(
+            self.sm.list_apps, DomainIdEquals=self.domain_id, UserProfileNameEquals=name
+        )["Apps"]
+        for app in apps:
+            if app["Status"] in ("Deleted", "Deleting"):
+                continue
+            self.call(
+                self.sm.delete_app,
+                DomainId=self.domain_id,
+                UserProfileName=name,
+                AppType=app["AppType"],
+                AppName=app["AppName"],
+            )
+        deadline = time.monotonic() + 600
+        while any(
+            k["Status"] not in ("Deleted", "Failed")
+            for k in self.call(
+                self.sm.list_apps,
+                DomainIdEquals=self.domain_id,
+                UserProfileNameEquals=name,
+            )["Apps"]
+        ):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Apps of {name} were not deleted")
+            time.sleep(10)
+
+        self.seed({"name": name}, "Delete")
+        self.call(
+            self.sm.delete_user_profile, DomainId=self.domain_id, UserProfileName=name
+        )
+        self.wait_for_status(name, ("Deleted",))
+
+    def plan(self) -> list:
+        """Return the list of (action, user) needed to match the roster.
+
+        Existing profiles are only updated or deleted when owned by the roster,
+        the listed users with a profile owned otherwise are planned as "skip".
+        """
+        users = {k["name"]: k for k in self.roster.get("users", [])}
+        existing = sorted(self.existing_profiles())
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            owned = dict(zip(existing, pool.map(self.owned_by_roster, existing)))
+        actions = [("create", users[k]) for k in sorted(users.keys() - owned.keys())]
+        for name in existing:
+            if name in users:
+                actions.append(("update" if owned[name] else "skip", users[name]))
+        actions += [
+            ("delete", {"name": k}) for k in existing if k not in users and owned[k]
+        ]
+        return actions
+
+    def run(self, concurrency: int) -> list:
+        actions = self.plan()
+        if self.dry_run:
+            for action, user in actions:
+                print(f"{action:8}{user['name']}")
+            return []
+
+        def apply(item):
+            action, user = item
+            start = time.monotonic()
+            try:
+                if action == "skip":
+                    # Created outside of this roster, e.g. by Service Catalog
+                    data = None
+                elif action == "delete":
+                    data = self.delete(user["name"])
+                else:
+                    data = getattr(self, action)(user)
+                error = None
+            except Exception as e:
+                data, error = None, str(e)
+            result = {
+                "user": user["name"],
+                "action": action,
+                "seconds": round(time.monotonic() - start, 1),
+                "seed": data,
+                "error": error,
+            }
+            print(json.dumps(result))
+            return result
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(apply, actions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("roster", help="YAML or JSON roster file")
+    parser.add_argument(
+        "--roster-name",
+        help="Name tagged on the profiles owned by this roster (default: file name)",
+    )
+    parser.add_argument("--domain-id", help="Default: the StudioDomainId export")
+    parser.add_argument(
+        "--function-name",
+        help="Home folder setup function (default: the StudioUserSetupFunctionName export)",
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=5,
+        help="Maximum SageMaker/Lambda calls per second",
+    )
+    parser.add_argument(
+        "--namespace", help="Namespace of the domain stacks deployed by fleet.py"
+    )
+    parser.add_argument(
+        "--lookup",
+        choices=["exports", "ssm"],
+        default="exports",
+        help="Read the domain values from the exports or the SSM parameters",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    session = boto3.Session()
+    prefix = f"{args.namespace}-" if args.namespace else ""
+    names = ["StudioDomainId", "SageMakerStudioUserRole", "StudioUserSetupFunctionName"]
+    if args.lookup == "ssm":
+        prefix = f"{PARAMETER_ROOT}/{prefix}"
+        exports = read_parameters(session.client("ssm"), [prefix + k for k in names])
+    else:
+        exports = read_exports(
+            session.client("cloudformation"), [prefix + k for k in names]
+        )
+    exports = {k[len(prefix) :]: v for k, v in exports.items()}
+    reconciler = Reconciler(
+        roster=load_roster(args.roster),
+        roster_name=args.roster_name or Path(args.roster).stem,
+        domain_id=args.domain_id or exports["StudioDomainId"],
+        default_role=exports.get("SageMakerStudioUserRole"),
+        function_name=args.function_name or exports.get("StudioUserSetupFunctionName"),
+        rate=args.rate,
+        dry_run=args.dry_run,
+        session=session,
+    )
+    results = reconciler.run(args.concurrency)
+    failed = [k for k in results if k["error"]]
+    skipped = [k for k in results if k["action"] == "skip"]
+    print(
+        f"{len(results)} users reconciled, {len(skipped)} skipped"
+        f" (not owned by the roster), {len(failed)} failed"
+    )
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
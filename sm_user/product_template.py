@@ -0,0 +1,75 @@
+import hashlib
+import importlib.metadata
+import os
+from pathlib import Path
+
+from aws_cdk import core as cdk
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Synthesized product templates, reused by the next runs of app.py
+CACHE_DIR = ROOT / ".cdk-cache"
+
+# Everything the StudioUserStack template depends on, besides the CDK version
+TEMPLATE_INPUTS = [
+    "sm_user/sm_user_stack.py",
+    "sm_user/studio_user.py",
+    "sm_common/shared_values.py",
+    "cdk.json",
+]
+
+
+def _inputs_hash(export_prefix: str, lookup: str) -> str:
+    sha = hashlib.sha256(importlib.metadata.version("aws-cdk.core").encode())
+    sha.update(export_prefix.encode())
+    sha.update(lookup.encode())
+    for name in TEMPLATE_INPUTS:
+        sha.update(name.encode())
+        sha.update((ROOT / name).read_bytes())
+    return sha.hexdigest()
+
+
+def studio_user_template(
+    scope: cdk.Construct,
+    export_prefix: str = "",
+    lookup: str = "exports",
+    cache_dir: Path = CACHE_DIR,
+) -> Path:
+    """Return the path of the StudioUserStack template for the product.
+
+    The stack is only synthesized, in a Stage under scope, when no template
+    was cached yet for the current content of TEMPLATE_INPUTS. Otherwise the
+    cached file is returned as is, so its hash, and the provisioning artifact
+    it ends up in, stay the same. The template reads the values published
+    with export_prefix and lookup, each pair has its own.
+    """
+    path = (
+        Path(cache_dir)
+        / f"StudioUserStack-{_inputs_hash(export_prefix, lookup)[:16]}.template.json"
+    )
+    if path.exists():
+        return path
+
+    # Only imported when the template is synthesized
+    from sm_user.sm_user_stack import SMSIAMUserStack
+
+    stage = cdk.Stage(scope, "IntermediateStage")
+    SMSIAMUserStack(
+        stage,
+        "StudioUserStack",
+        synthesizer=cdk.BootstraplessSynthesizer(),
+        export_prefix=export_prefix,
+        lookup=lookup,
+    )
+    assembly = stage.synth(force=True)
+    template = Path(assembly.stacks[0].template_full_path).read_bytes()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f".{path.name}.partial")
+    partial.write_bytes(template)
+    os.replace(partial, path)
+    return path
+
+
+def template_hash(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
@@ -0,0 +1,37 @@
+import gzip
+import os
+import tarfile
+from pathlib import Path
+
+
+def _normalize(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    # Strip everything that changes between builds of identical content, so the
+    # asset hash, and the provisioned archive, only change with the files
+    info.mtime = 0
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+def build_seed_archive(source_dir: str, out_dir: str) -> str:
+    """Package source_dir as a reproducible tar.gz in out_dir and return its path.
+
+    The archive holds a single top level folder named after source_dir, which
+    is extracted as is into the home folder of each user.
+    """
+    source = Path(source_dir).resolve()
+    archive_path = Path(out_dir) / f"{source.name}.tar.gz"
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(archive_path, "wb") as fp, gzip.GzipFile(
+        filename="", mode="wb", fileobj=fp, mtime=0
+    ) as gz, tarfile.open(fileobj=gz, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for folder, dirs, files in os.walk(source):
+            dirs.sort()
+            folder = Path(folder)
+            arcname = Path(source.name) / folder.relative_to(source)
+            tar.add(folder, arcname=str(arcname), recursive=False, filter=_normalize)
+            for name in sorted(files):
+                tar.add(folder / name, arcname=str(arcname / name), filter=_normalize)
+
+    return str(archive_path)
@@ -2,40 +2,76 @@ from aws_cdk import aws_iam as iam
 from aws_cdk import aws_s3_assets as s3assets
 from aws_cdk import aws_servicecatalog as servicecatalog
 from aws_cdk import core as cdk
+from sm_common.shared_values import SharedValues
 from sm_domain.sm_domain_stack import SMSDomainStack
 
+from sm_user.product_template import studio_user_template, template_hash
+from sm_user.seed_archive import build_seed_archive
 from sm_user.sm_studio_user_lambda_construct import StudioUserLambda
-from sm_user.sm_user_stack import SMSIAMUserStack
 
 
 class ServiceCatalogStudioUserStack(cdk.Stack):
     def __init__(
-        self, scope: cdk.Construct, construct_id: str, domain: SMSDomainStack, **kwargs
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        domain: SMSDomainStack,
+        seed_source: str = None,
+        home_template: str = None,
+        datasets: dict = None,
+        staging_storage_mb: int = None,
+        usage_report: bool = False,
+        async_mode: bool = False,
+        export_prefix: str = "",
+        lookup: str = "exports",
+        **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # Package the optional seed folder once, users with SourceType "s3"
+        # get it extracted in their home instead of cloning from git
+        seed_archive_path = None
+        if seed_source is not None:
+            seed_archive_path = build_seed_archive(
+                seed_source, cdk.FileSystem.mkdtemp("seed-archive")
+            )
+        # Dotfiles, JupyterLab settings, kernel specs... applied to every home
+        home_template_path = None
+        if home_template is not None:
+            home_template_path = build_seed_archive(
+                home_template, cdk.FileSystem.mkdtemp("home-template")
+            )
+
         # Create the Lambda Stack for pre-populating the user home directory
         studio_user_lambda = StudioUserLambda(
-            self, "FnPopulateStudioUser", vpc=domain.vpc, domain=domain.domain
-        )
-
-        # Generate the CF template for the studio user
-        stage = cdk.Stage(self, "IntermediateStage")
-        SMSIAMUserStack(
-            stage,
-            "StudioUserStack",
-            synthesizer=cdk.BootstraplessSynthesizer(),
+            self,
+            "FnPopulateStudioUser",
+            vpc=domain.vpc,
+            domain=domain.domain,
+            seed_archive_path=seed_archive_path,
+            home_template_path=home_template_path,
+            datasets=datasets,
+            staging_storage_mb=staging_storage_mb,
+            usage_report=usage_report,
+            async_mode=async_mode,
+            export_prefix=export_prefix,
+            lookup=lookup,
+            # Cross-stack references need both stacks in the same environment
+            env=kwargs.get("env"),
         )
-        assembly = stage.synth(force=True)
 
-        # Retrive the local path of the CF template
-        template_full_path = assembly.stacks[0].template_full_path
+        # Generate the CF template for the studio user, or reuse the one cached
+        # by an earlier run
+        template_path = studio_user_template(self, export_prefix, lookup)
 
-        # Upload CF template to s3 to create an asset to reference
+        # Upload CF template to s3 to create an asset to reference. Hashed on
+        # the template alone: a new provisioning artifact only when it changes
         s3_asset = s3assets.Asset(
             self,
             "TemplateAsset",
-            path=template_full_path,
+            path=str(template_path),
+            asset_hash=template_hash(template_path),
+            asset_hash_type=cdk.AssetHashType.CUSTOM,
         )
 
         # Create the Service Catalog product referencing the CF template
@@ -72,7 +108,7 @@ class ServiceCatalogStudioUserStack(cdk.Stack):
             self,
             "StudioAdminRole",
             assumed_by=iam.AnyPrincipal(),
-            role_name="SageMakerStudioAdminRole",
+            role_name=f"{export_prefix}SageMakerStudioAdminRole",
             managed_policies=[
                 iam.ManagedPolicy.from_aws_managed_policy_name(
                     "AWSServiceCatalogEndUserFullAccess"
@@ -110,6 +146,17 @@ class ServiceCatalogStudioUserStack(cdk.Stack):
                 resources=["*"],
             )
         )
+        if lookup == "ssm":
+            # The product reads the domain values when provisioned
+            sc_role.add_to_policy(
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=[
+                        "ssm:GetParameters",
+                    ],
+                    resources=[SharedValues(export_prefix, lookup).parameter_arn(self)],
+                )
+            )
 
         cdk.CfnOutput(
             self,
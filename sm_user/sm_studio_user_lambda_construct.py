@@ -1,13 +1,20 @@
+import json
+
 from aws_cdk import aws_ec2 as ec2
 from aws_cdk import aws_efs as efs
+from aws_cdk import aws_events as events
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_lambda as lambda_
 from aws_cdk import aws_lambda_python as lambda_python
+from aws_cdk import aws_s3 as s3
+from aws_cdk import aws_s3_assets as s3assets
 
 # from aws_cdk import aws_logs as logs
 from aws_cdk import aws_sagemaker as sagemaker
 from aws_cdk import core as cdk
 from aws_cdk import custom_resources as cr
+from sm_common.runtime_layer import AwsRuntimeLayer
+from sm_common.shared_values import SharedValues
 
 
 class StudioUserLambda(cdk.Stack):
@@ -17,13 +24,27 @@ class StudioUserLambda(cdk.Stack):
         construct_id: str,
         vpc: ec2.Vpc,
         domain: sagemaker.CfnDomain,
+        seed_archive_path: str = None,
+        home_template_path: str = None,
+        datasets: dict = None,
+        staging_storage_mb: int = None,
+        usage_report: bool = False,
+        async_mode: bool = False,
+        export_prefix: str = "",
+        lookup: str = "exports",
         **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
-        studio_domain_id = (
-            domain.attr_domain_id
-        )  # cdk.Fn.import_value("StudioDomainId")
+        shared_values = SharedValues(export_prefix, lookup)
+        if lookup == "ssm":
+            # Read when deployed, the domain stack is free to update
+            studio_domain_id = shared_values.resolve(self, "StudioDomainId")
+            self.add_dependency(cdk.Stack.of(domain))
+        else:
+            studio_domain_id = (
+                domain.attr_domain_id
+            )  # cdk.Fn.import_value("StudioDomainId")
 
         # Get the security group associated with the EFS volume managed by SageMaker Studio
         get_parameter = cr.AwsCustomResource(
@@ -55,7 +76,7 @@ class StudioUserLambda(cdk.Stack):
         )
 
         # We can now retrive a handler for the EFS volume
-        StudioDomainEfsId = cdk.Fn.import_value("StudioDomainEfsId")
+        StudioDomainEfsId = shared_values.resolve(self, "StudioDomainEfsId")
         studio_efs = efs.FileSystem.from_file_system_attributes(
             self, "StudioEFS", file_system_id=StudioDomainEfsId, security_group=sg_efs
         )
@@ -68,46 +89,275 @@ class StudioUserLambda(cdk.Stack):
             posix_user=efs.PosixUser(gid="0", uid="0"),
         )
 
+        git_layer = lambda_.LayerVersion.from_layer_version_arn(
+            self,
+            "GitLayer",
+            layer_version_arn=f"arn:aws:lambda:{self.region}:553035198032:layer:git-lambda2:8",
+        )
+        runtime_layer = AwsRuntimeLayer(self, "AwsRuntimeLayer")
+
+        environment = {"ASYNC_MODE": "true" if async_mode else "false"}
+        if staging_storage_mb:
+            # Clone to the local storage, then copy to EFS in parallel
+            environment["STAGING_ROOT"] = "/tmp/staging"
+
+        def setup_function(id, handler, timeout):
+            fn = lambda_python.PythonFunction(
+                self,
+                id,
+                entry="populate_git_fn",
+                index="populate_from_git.py",
+                handler=handler,
+                vpc=vpc,
+                layers=[git_layer, runtime_layer],
+                filesystem=lambda_.FileSystem.from_efs_access_point(efs_ap, "/mnt/efs"),
+                timeout=timeout,
+                environment=environment,
+                initial_policy=[
+                    iam.PolicyStatement(
+                        effect=iam.Effect.ALLOW,
+                        actions=[
+                            "sagemaker:DescribeUserProfile",
+                        ],
+                        resources=["*"],
+                    )
+                ],
+            )
+            if staging_storage_mb:
+                # Room for the largest checkout, up to 10240 MB
+                fn.node.default_child.add_property_override(
+                    "EphemeralStorage.Size", staging_storage_mb
+                )
+            return fn
+
         # Function that takes care of setting up the user environment
-        self.lambda_fn = lambda_python.PythonFunction(
+        self.lambda_fn = setup_function(
+            "UserSetupLambdaFn", "on_event", cdk.Duration.seconds(300)
+        )
+        setup_functions = [self.lambda_fn]
+
+        # In asynchronous mode the function above only queues the work, which is
+        # then carried out by this one, polled by the provider until done. The
+        # setup is no longer bound by the 15 minutes limit of a single invocation.
+        complete_fn = None
+        if async_mode:
+            complete_fn = setup_function(
+                "UserSetupCompleteLambdaFn", "is_complete", cdk.Duration.minutes(15)
+            )
+            setup_functions.append(complete_fn)
+
+        # Function that deletes, over as many runs as needed, the folders the setup
+        # function moved to the trash area of the EFS volume
+        purge_fn = lambda_python.PythonFunction(
             self,
-            "UserSetupLambdaFn",
+            "PurgeTrashLambdaFn",
             entry="populate_git_fn",
-            index="populate_from_git.py",
-            handler="on_event",
+            index="purge_trash.py",
+            handler="on_schedule",
             vpc=vpc,
-            layers=[
-                lambda_.LayerVersion.from_layer_version_arn(
-                    self,
-                    "GitLayer",
-                    layer_version_arn=f"arn:aws:lambda:{self.region}:553035198032:layer:git-lambda2:8",
-                ),
-            ],
             filesystem=lambda_.FileSystem.from_efs_access_point(efs_ap, "/mnt/efs"),
-            timeout=cdk.Duration.seconds(300),
-            initial_policy=[
-                iam.PolicyStatement(
-                    effect=iam.Effect.ALLOW,
-                    actions=[
-                        "sagemaker:DescribeUserProfile",
-                    ],
-                    resources=["*"],
+            timeout=cdk.Duration.minutes(15),
+            # A single purge at a time, each run resumes where the previous one stopped
+            reserved_concurrent_executions=1,
+        )
+        purge_schedule = events.CfnRule(
+            self,
+            "PurgeTrashSchedule",
+            schedule_expression="rate(15 minutes)",
+            targets=[
+                events.CfnRule.TargetProperty(
+                    arn=purge_fn.function_arn, id="PurgeTrashLambdaFn"
                 )
             ],
         )
-
-        provider = cr.Provider(
-            self,
-            "Provider",
-            on_event_handler=self.lambda_fn,
+        purge_fn.add_permission(
+            "PurgeTrashSchedulePermission",
+            principal=iam.ServicePrincipal("events.amazonaws.com"),
+            source_arn=purge_schedule.attr_arn,
         )
 
-        cdk.CfnOutput(
+        # Default snapshot for the users provisioned with SourceType "s3"
+        if seed_archive_path is not None:
+            seed_archive = s3assets.Asset(
+                self, "SeedArchiveAsset", path=seed_archive_path
+            )
+            for fn in setup_functions:
+                seed_archive.grant_read(fn)
+                fn.add_environment("DEFAULT_SEED_ARCHIVE", seed_archive.s3_object_url)
+
+        # Files every user home gets, kept on the EFS volume by version and
+        # applied by the setup function
+        if home_template_path is not None:
+            home_template = s3assets.Asset(
+                self, "HomeTemplateAsset", path=home_template_path
+            )
+            install_fn = lambda_python.PythonFunction(
+                self,
+                "HomeTemplateLambdaFn",
+                entry="populate_git_fn",
+                index="install_template.py",
+                handler="on_event",
+                vpc=vpc,
+                layers=[runtime_layer],
+                filesystem=lambda_.FileSystem.from_efs_access_point(efs_ap, "/mnt/efs"),
+                timeout=cdk.Duration.minutes(15),
+            )
+            home_template.grant_read(install_fn)
+            template_provider = cr.Provider(
+                self, "HomeTemplateProvider", on_event_handler=install_fn
+            )
+            cdk.CustomResource(
+                self,
+                "HomeTemplate",
+                service_token=template_provider.service_token,
+                properties={
+                    "ArchiveUri": home_template.s3_object_url,
+                    # Changes with the content, and only then
+                    "Version": home_template.asset_hash,
+                },
+            )
+
+        # Read-only cache of the S3 datasets, refreshed in the background and
+        # linked into the homes of the users who ask for them
+        if datasets:
+            sync_fn = lambda_python.PythonFunction(
+                self,
+                "SyncDatasetsLambdaFn",
+                entry="populate_git_fn",
+                index="sync_datasets.py",
+                handler="on_schedule",
+                vpc=vpc,
+                layers=[runtime_layer],
+                filesystem=lambda_.FileSystem.from_efs_access_point(efs_ap, "/mnt/efs"),
+                timeout=cdk.Duration.minutes(15),
+                memory_size=1024,
+                environment={"DATASETS": json.dumps(datasets)},
+                # A single sync at a time, each run resumes where the previous one stopped
+                reserved_concurrent_executions=1,
+            )
+            for uri in datasets.values():
+                bucket, _, prefix = uri[len("s3://") :].partition("/")
+                sync_fn.add_to_role_policy(
+                    iam.PolicyStatement(
+                        actions=["s3:ListBucket"],
+                        resources=[f"arn:aws:s3:::{bucket}"],
+                        conditions={"StringLike": {"s3:prefix": [f"{prefix}*"]}},
+                    )
+                )
+                sync_fn.add_to_role_policy(
+                    iam.PolicyStatement(
+                        actions=["s3:GetObject"],
+                        resources=[f"arn:aws:s3:::{bucket}/{prefix}*"],
+                    )
+                )
+            sync_schedule = events.CfnRule(
+                self,
+                "SyncDatasetsSchedule",
+                schedule_expression="rate(30 minutes)",
+                targets=[
+                    events.CfnRule.TargetProperty(
+                        arn=sync_fn.function_arn, id="SyncDatasetsLambdaFn"
+                    )
+                ],
+            )
+            sync_fn.add_permission(
+                "SyncDatasetsSchedulePermission",
+                principal=iam.ServicePrincipal("events.amazonaws.com"),
+                source_arn=sync_schedule.attr_arn,
+            )
+
+        # Hourly per-user usage of the EFS volume, as metrics and as a JSON
+        # lines report in a bucket of its own
+        if usage_report:
+            report_bucket = s3.Bucket(
+                self,
+                "UsageReportBucket",
+                encryption=s3.BucketEncryption.S3_MANAGED,
+                block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+            )
+            usage_fn = lambda_python.PythonFunction(
+                self,
+                "ScanUsageLambdaFn",
+                entry="populate_git_fn",
+                index="scan_usage.py",
+                handler="on_schedule",
+                vpc=vpc,
+                layers=[runtime_layer],
+                filesystem=lambda_.FileSystem.from_efs_access_point(efs_ap, "/mnt/efs"),
+                timeout=cdk.Duration.minutes(15),
+                memory_size=1024,
+                environment={
+                    "DOMAIN_ID": studio_domain_id,
+                    "REPORT_BUCKET": report_bucket.bucket_name,
+                },
+                initial_policy=[
+                    iam.PolicyStatement(
+                        effect=iam.Effect.ALLOW,
+                        actions=[
+                            "sagemaker:ListUserProfiles",
+                            "sagemaker:DescribeUserProfile",
+                        ],
+                        resources=["*"],
+                    )
+                ],
+                # A single scan at a time, each run starts with the homes the
+                # previous one did not reach
+                reserved_concurrent_executions=1,
+            )
+            report_bucket.grant_put(usage_fn)
+            usage_schedule = events.CfnRule(
+                self,
+                "ScanUsageSchedule",
+                schedule_expression="rate(1 hour)",
+                targets=[
+                    events.CfnRule.TargetProperty(
+                        arn=usage_fn.function_arn, id="ScanUsageLambdaFn"
+                    )
+                ],
+            )
+            usage_fn.add_permission(
+                "ScanUsageSchedulePermission",
+                principal=iam.ServicePrincipal("events.amazonaws.com"),
+                source_arn=usage_schedule.attr_arn,
+            )
+            cdk.CfnOutput(
+                self,
+                "StudioUsageReportBucket",
+                value=report_bucket.bucket_name,
+                description="StudioUsageReportBucket",
+            )
+
+        if async_mode:
+            provider = cr.Provider(
+                self,
+                "Provider",
+                on_event_handler=self.lambda_fn,
+                is_complete_handler=complete_fn,
+                query_interval=cdk.Duration.seconds(30),
+                total_timeout=cdk.Duration.hours(2),
+            )
+        else:
+            provider = cr.Provider(
+                self,
+                "Provider",
+                on_event_handler=self.lambda_fn,
+            )
+
+        shared_values.publish(
             self,
             "StudioUserProviderToken",
+            "StudioUserProviderToken",
             value=provider.service_token,
             description="StudioUserProviderToken",
-            export_name="StudioUserProviderToken",
+        )
+
+        # Lets the roster reconciler run the setup without a CloudFormation stack per user
+        shared_values.publish(
+            self,
+            "StudioUserSetupFunctionName",
+            "StudioUserSetupFunctionName",
+            value=self.lambda_fn.function_name,
+            description="StudioUserSetupFunctionName",
         )
 
         self.provider = provider
@@ -1,8 +1,9 @@
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_sagemaker as sagemaker
 from aws_cdk import core as cdk
-from sm_domain.sm_domain_stack import SMSDomainStack
+from sm_common.shared_values import SharedValues
 
+from sm_user.studio_user import add_studio_user
 
 
 class SMSIAMUserStack(cdk.Stack):
@@ -11,7 +12,9 @@ class SMSIAMUserStack(cdk.Stack):
         scope: cdk.Construct,
         construct_id: str,
         # domain: SMSDomainStack,
-        **kwargs
+        export_prefix: str = "",
+        lookup: str = "exports",
+        **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
@@ -30,53 +33,147 @@ class SMSIAMUserStack(cdk.Stack):
             description="Git Repository",
             default="https://github.com/acere/SagemakerStudioCDK.git",
         )
+        git_repositories = cdk.CfnParameter(
+            self,
+            "GitRepositories",
+            type="String",
+            description=(
+                "JSON list of repositories to clone instead of GitRepository, e.g."
+                ' [{"url": "https://host/course.git", "ref": "main", "folder": "course"}]'
+            ),
+            default="",
+        )
 
-        # Read the StudioDomainId exported by the StudioDomain stack
-        StudioDomainId = cdk.Fn.import_value("StudioDomainId")
-        role_arn = cdk.Fn.import_value("SageMakerStudioUserRole")
-
-        user_settings = sagemaker.CfnUserProfile.UserSettingsProperty(
-            execution_role=role_arn
+        # Optional clone settings to fetch only the history and paths the user needs
+        git_branch = cdk.CfnParameter(
+            self,
+            "GitBranch",
+            type="String",
+            description="Branch or tag to clone (empty for the remote default branch)",
+            default="",
         )
-        user = sagemaker.CfnUserProfile(
+        git_depth = cdk.CfnParameter(
             self,
-            "user",
-            domain_id=StudioDomainId,
-            # single_sign_on_user_identifier="UserName",
-            # single_sign_on_user_value="SSOUserName",
-            user_profile_name=user_name.value_as_string,
-            user_settings=user_settings,
+            "GitDepth",
+            type="Number",
+            description="Number of commits of history to fetch (0 for the full history)",
+            default=0,
+            min_value=0,
+        )
+        git_filter = cdk.CfnParameter(
+            self,
+            "GitFilter",
+            type="String",
+            description="Partial clone filter",
+            default="",
+            allowed_values=["", "blob:none", "tree:0"],
+        )
+        git_sparse_paths = cdk.CfnParameter(
+            self,
+            "GitSparsePaths",
+            type="String",
+            description="Comma separated list of folders to check out (empty for all)",
+            default="",
+        )
+        git_cache = cdk.CfnParameter(
+            self,
+            "GitCache",
+            type="String",
+            description=(
+                "Clone from a mirror shared on the Studio EFS: 'dissociate' copies the objects"
+                " into the user repository"
+            ),
+            default="none",
+            allowed_values=["none", "dissociate"],
         )
-        user_id = user.user_profile_name
 
-        cdk.CfnOutput(
+        source_type = cdk.CfnParameter(
             self,
-            "UserID",
-            value=user_id,
-            description="SageMaker Studio User ID",
-            export_name="StudioUserId",
+            "SourceType",
+            type="String",
+            description="Seed the home folder by cloning from git or from a tar archive in S3",
+            default="git",
+            allowed_values=["git", "s3"],
+        )
+        seed_archive = cdk.CfnParameter(
+            self,
+            "SeedArchive",
+            type="String",
+            description=(
+                "s3:// URI of a tar.gz or tar.zst archive readable by the setup function"
+                " (empty for the archive packaged with the product)"
+            ),
+            default="",
+        )
+        datasets = cdk.CfnParameter(
+            self,
+            "Datasets",
+            type="String",
+            description=(
+                "Comma-separated names of the datasets cached on the Studio EFS to expose"
+                " in the datasets folder of the home"
+            ),
+            default="",
+        )
+        dataset_link_mode = cdk.CfnParameter(
+            self,
+            "DatasetLinkMode",
+            type="String",
+            description=(
+                "'hardlink' links every file of the datasets, 'symlink' links the cache"
+                " folder, which only resolves where the whole EFS is mounted"
+            ),
+            default="hardlink",
+            allowed_values=["hardlink", "symlink"],
+        )
+        delete_policy = cdk.CfnParameter(
+            self,
+            "DeletePolicy",
+            type="String",
+            description=(
+                "What happens to the home folder when the product is terminated:"
+                " 'Delete' removes it in the background, 'Archive' moves it aside"
+                " on the Studio EFS"
+            ),
+            default="Retain",
+            allowed_values=["Retain", "Delete", "Archive"],
         )
 
-        provider_service_token = cdk.Fn.import_value("StudioUserProviderToken")
-        cr_users_init = cdk.CustomResource(
+        # Read the StudioDomainId published by the StudioDomain stack
+        shared_values = SharedValues(export_prefix, lookup)
+        StudioDomainId = shared_values.resolve(self, "StudioDomainId")
+        role_arn = shared_values.resolve(self, "SageMakerStudioUserRole")
+
+        user_settings = sagemaker.CfnUserProfile.UserSettingsProperty(
+            execution_role=role_arn
+        )
+        provider_service_token = shared_values.resolve(self, "StudioUserProviderToken")
+        user, self.JupyterApp = add_studio_user(
             self,
-            "PopulateUserLambda",
-            # service_token=provider.service_token,
+            user_name.value_as_string,
+            domain_id=StudioDomainId,
+            user_settings=user_settings,
             service_token=provider_service_token,
             properties={
-                "StudioUserName": user.user_profile_name,
-                "DomainID": StudioDomainId,
                 "GitRepository": git_repository,
+                "GitRepositories": git_repositories,
+                "GitBranch": git_branch,
+                "GitDepth": git_depth,
+                "GitFilter": git_filter,
+                "GitSparsePaths": git_sparse_paths,
+                "GitCache": git_cache,
+                "SourceType": source_type,
+                "SeedArchive": seed_archive,
+                "Datasets": datasets,
+                "DatasetLinkMode": dataset_link_mode,
+                "DeletePolicy": delete_policy,
             },
         )
-        cr_users_init.node.add_dependency(user)
 
-        self.JupyterApp = sagemaker.CfnApp(
+        cdk.CfnOutput(
             self,
-            "DefaultStudioApp",
-            app_name="default",
-            app_type="JupyterServer",
-            domain_id=StudioDomainId,
-            user_profile_name=user_id,
+            "UserID",
+            value=user.user_profile_name,
+            description="SageMaker Studio User ID",
+            export_name="StudioUserId",
         )
-        self.JupyterApp.add_depends_on(user)
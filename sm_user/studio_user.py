@@ -0,0 +1,50 @@
+from aws_cdk import aws_sagemaker as sagemaker
+from aws_cdk import core as cdk
+
+
+def add_studio_user(
+    scope: cdk.Construct,
+    user_name: str,
+    domain_id: str,
+    user_settings: sagemaker.CfnUserProfile.UserSettingsProperty,
+    service_token: str,
+    properties: dict,
+) -> tuple:
+    """Declare a Studio user in scope: its profile, the custom resource setting
+    up its home folder with properties and its default JupyterServer app.
+
+    The resources get the ids they have in the StudioUserStack product, so
+    that the provisioned products keep them. Returns the profile and the app.
+    """
+    user = sagemaker.CfnUserProfile(
+        scope,
+        "user",
+        domain_id=domain_id,
+        # single_sign_on_user_identifier="UserName",
+        # single_sign_on_user_value="SSOUserName",
+        user_profile_name=user_name,
+        user_settings=user_settings,
+    )
+
+    cr_users_init = cdk.CustomResource(
+        scope,
+        "PopulateUserLambda",
+        service_token=service_token,
+        properties={
+            "StudioUserName": user.user_profile_name,
+            "DomainID": domain_id,
+            **properties,
+        },
+    )
+    cr_users_init.node.add_dependency(user)
+
+    app = sagemaker.CfnApp(
+        scope,
+        "DefaultStudioApp",
+        app_name="default",
+        app_type="JupyterServer",
+        domain_id=domain_id,
+        user_profile_name=user.user_profile_name,
+    )
+    app.add_depends_on(user)
+    return user, app
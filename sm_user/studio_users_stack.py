@@ -0,0 +1,132 @@
+import json
+import math
+import zlib
+
+from aws_cdk import aws_sagemaker as sagemaker
+from aws_cdk import core as cdk
+from sm_common.shared_values import SharedValues
+
+from sm_user.studio_user import add_studio_user
+
+# CloudFormation quota of resources in a stack
+MAX_STACK_RESOURCES = 500
+# Profile, home folder setup and default app
+RESOURCES_PER_USER = 3
+# Users per shard to size the number of shards for: leaves room for users
+# hashed unevenly, and for those added later, below the quota
+USERS_PER_SHARD = 50
+
+
+def shard_of(user_name: str, shards: int) -> int:
+    """Return the shard of user_name, which only depends on its name."""
+    return zlib.crc32(user_name.encode()) % shards
+
+
+class StudioUserProfiles(cdk.Construct):
+    """Studio users declared from a roster, in nested stacks deployed in parallel.
+
+    The roster has the format of the sm_roster reconciler. Every user gets its
+    profile, with the settings of its tier, the custom resource seeding its
+    home folder with its repositories, and its default app.
+
+    Users are spread over the shards by a hash of their name, so adding or
+    removing a user leaves the others where they are. Changing the number of
+    shards moves most users to another nested stack, where their profile is
+    created again under the same name, which fails the update: the number is
+    never derived from the roster, and should leave room for the users added
+    later, e.g. a shard for every USERS_PER_SHARD users.
+    """
+
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        roster: dict,
+        domain_id: str,
+        default_role_arn: str,
+        service_token: str,
+        shards: int,
+    ) -> None:
+        super().__init__(scope, construct_id)
+
+        users = roster.get("users", [])
+        if not shards or shards < 1:
+            raise ValueError(
+                "The number of shards is required, e.g."
+                f" {max(1, math.ceil(len(users) / USERS_PER_SHARD))} for"
+                f" {len(users)} users, and cannot change once deployed"
+            )
+        by_shard = [[] for _ in range(shards)]
+        for user in users:
+            by_shard[shard_of(user["name"], shards)].append(user)
+        largest = max(len(k) for k in by_shard)
+        if largest * RESOURCES_PER_USER > MAX_STACK_RESOURCES:
+            raise ValueError(
+                f"{largest} users in a shard, over the {MAX_STACK_RESOURCES}"
+                " resources quota: raise the number of shards"
+            )
+
+        self.shards = []
+        for index, shard_users in enumerate(by_shard):
+            # Nested stacks without dependencies between them are deployed
+            # at the same time
+            shard = cdk.NestedStack(self, f"Shard{index}")
+            for user in shard_users:
+                add_studio_user(
+                    cdk.Construct(shard, user["name"]),
+                    user["name"],
+                    domain_id=domain_id,
+                    user_settings=self.user_settings(roster, user, default_role_arn),
+                    service_token=service_token,
+                    properties={
+                        "GitRepository": "",
+                        "GitRepositories": json.dumps(user.get("repositories", [])),
+                        "Datasets": ",".join(user.get("datasets", [])),
+                        "DeletePolicy": user.get("delete_policy", "Retain"),
+                    },
+                )
+            self.shards.append(shard)
+
+    @staticmethod
+    def user_settings(roster: dict, user: dict, default_role_arn: str):
+        tier = roster.get("tiers", {}).get(user.get("tier", "default"), {})
+        kernel_gateway_app_settings = None
+        if "instance_type" in tier:
+            kernel_gateway_app_settings = (
+                sagemaker.CfnUserProfile.KernelGatewayAppSettingsProperty(
+                    default_resource_spec=sagemaker.CfnUserProfile.ResourceSpecProperty(
+                        instance_type=tier["instance_type"]
+                    )
+                )
+            )
+        return sagemaker.CfnUserProfile.UserSettingsProperty(
+            execution_role=tier.get("execution_role", default_role_arn),
+            kernel_gateway_app_settings=kernel_gateway_app_settings,
+        )
+
+
+class StudioUsersStack(cdk.Stack):
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        roster: dict,
+        shards: int,
+        export_prefix: str = "",
+        lookup: str = "exports",
+        **kwargs,
+    ) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        # Published by the domain and the StudioUserLambda stacks. Read once
+        # here with the "ssm" lookup, the shards get the values as parameters
+        shared_values = SharedValues(export_prefix, lookup)
+        StudioUserProfiles(
+            self,
+            "Users",
+            roster=roster,
+            domain_id=shared_values.resolve(self, "StudioDomainId"),
+            default_role_arn=shared_values.resolve(self, "SageMakerStudioUserRole"),
+            service_token=shared_values.resolve(self, "StudioUserProviderToken"),
+            shards=shards,
+        )